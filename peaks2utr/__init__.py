@@ -43,6 +43,15 @@ def prepare_argparser():
                              'Default: 0')
     parser.add_argument('--skip-soft-clip', action="store_true",
                         help="skip the resource-intensive logic to pileup soft-clipped read edges")
+    parser.add_argument('--spat-region-size', type=int, default=10000000,
+                        help="size in bases of the regions each processor piles up soft-clipped reads over. Set to 0 to "
+                             "use whole chromosomes. Default: 10000000")
+    parser.add_argument('--split-read-groups', action="store_true",
+                        help="pile up soft-clipped reads per read-group, splitting BAM_IN into one file per read-group "
+                             "rather than sharding by region")
+    parser.add_argument('--lazy-coverage-gaps', action="store_true",
+                        help="find zero coverage intervals only around candidate UTR ends as required, rather than "
+                             "genome-wide up front. Faster for sparse libraries")
     parser.add_argument('--min-pileups', type=int, default=10, help='minimum number of piled-up mapped reads for UTR cut-off. '
                                                                     'Default: 10')
     parser.add_argument('--min-poly-tail', type=int, default=10,
@@ -51,11 +60,23 @@ def prepare_argparser():
                         help="annotate 3' UTR also for pseudogenic transcripts.")
     parser.add_argument('--no-strand-overlap', action="store_true",
                         help="Prevent overlapping of new UTR feature with any feature on other strand (truncating if necessary).")
+    parser.add_argument('--sweep', action="store_true",
+                        help="annotate peaks by sweeping through peaks and genes sorted per chromosome and strand, rather "
+                        "than looking up genes near each peak in turn.")
+    parser.add_argument('--batch-criteria', action="store_true",
+                        help="evaluate criteria at once over arrays of all peaks and nearby genes per chromosome and "
+                        "strand. Implies --sweep.")
     parser.add_argument('-p', '--processors', type=int, default=1, help="how many processor cores to use. Default: 1")
     parser.add_argument('-f', '-force', '--force', action="store_true", help="overwrite outputs if they exist")
     parser.add_argument('-o', '--output', help="output filename. Defaults to <GFF_IN basename>.new.<ext>")
     parser.add_argument('--gtf-in', default=False, help=argparse.SUPPRESS)
     parser.add_argument('--gtf', dest="gtf_out", action="store_true", help="output in GTF format (rather than default GFF3)")
+    parser.add_argument('--pass-through', action="store_true",
+                        help="copy lines of GFF_IN verbatim to output, rewriting only genes and transcripts with a new "
+                        "3' UTR, rather than writing all genes sorted. Requires output in the same format as GFF_IN")
+    parser.add_argument('--low-memory', action="store_true",
+                        help="hold features of genes in an on-disk store until output, rather than all in memory. "
+                        "Slower, for very large annotations")
     parser.add_argument('--skip-validation', action="store_true", help="skip validation of input files")
     parser.add_argument('--keep-cache', action="store_true", help="keep cached files on run completion")
     parser.add_argument('--version', action='version', version='%(prog)s {version}'.format(version=version(__package__)))
@@ -102,10 +123,11 @@ async def _main(args):
 
     from . import constants
     from .annotations import AnnotationsPipeline
-    from .collections import AnnotationsDict, BroadPeaksList
-    from .utils import cached, get_output_filename, yield_from_process
+    from .collections import AnnotationsDict, BroadPeaksList, DiskAnnotationsDict
+    from .utils import cached, get_output_filename
     from .preprocess import BAMSplitter, call_peaks, create_db
-    from .postprocess import merge_annotations, gt_gff3_sort, write_summary_stats
+    from .postprocess import merge_annotations, write_pass_through_annotations, write_sorted_annotations, \
+        write_summary_stats
     from .validation import matching_chr, valid_bam
 
     try:
@@ -157,6 +179,10 @@ async def _main(args):
             logging.error("Only one of --extend-utr and --override-utr can be used simultaneously. Aborting.")
             sys.exit(1)
 
+        if args.pass_through and args.gtf_in != args.gtf_out:
+            logging.warning("--pass-through requires output in the same format as GFF_IN. Writing sorted output.")
+            args.pass_through = False
+
         if not args.skip_validation:
             logging.info("Performing input file validation.")
             valid_bam(args)
@@ -183,20 +209,29 @@ async def _main(args):
         # Process peaks   #
         ###################
 
-        annotations = AnnotationsDict(args=args)
-        with AnnotationsPipeline(peaks, args, db_path=db) as pipeline:
-            for p in pipeline.processes:
-                for result in yield_from_process(pipeline.queue, p, pipeline.pbar):
+        if args.low_memory:
+            annotations = DiskAnnotationsDict(args=args, store_fn=cached("annotations_store.db"))
+        else:
+            annotations = AnnotationsDict(args=args)
+        try:
+            with AnnotationsPipeline(peaks, args, db_path=db, bam_basename=bam_basename) as pipeline:
+                for result in pipeline.iter_results():
                     if result:
-                        annotations.update(result)
-
-        ###################
-        # Post-processing #
-        ###################
-
-        merge_annotations(db, annotations)
-        gt_gff3_sort(annotations, new_gff_fn, args.force, args.gtf_out)
-        write_summary_stats(annotations, pipeline)
+                        annotations.add_utr(result)
+
+            ###################
+            # Post-processing #
+            ###################
+
+            merge_annotations(db, annotations, include_untouched=not args.pass_through)
+            if args.pass_through:
+                feature_counts = write_pass_through_annotations(annotations, args.GFF_IN, new_gff_fn)
+            else:
+                write_sorted_annotations(annotations, new_gff_fn)
+                feature_counts = None
+            write_summary_stats(annotations, pipeline, feature_counts)
+        finally:
+            annotations.close()
 
         logging.info("%s finished successfully." % __package__)
         await asyncio.sleep(1)
@@ -1,15 +1,23 @@
+import collections
+import copy
+import heapq
+import itertools
 import logging
-import math
 import multiprocessing
+from multiprocessing.connection import wait
+from queue import Empty
+import time
 
+import numpy as np
 from tqdm import tqdm
 
 from . import constants, criteria
 from .constants import AnnotationColour, STRAND_MAP
-from .collections import SPATTruncationPointsDict, ZeroCoverageIntervalsDict
+from .collections import AnnotationIndex, LazyZeroCoverageIntervalsDict, SPATTruncationPointsDict, \
+    ZeroCoverageIntervalsDict
 from .exceptions import AnnotationsError
-from .models import UTR
-from .utils import Counter, Falsey, cached, connect_db, features_dict_for_gene, iter_batches
+from .models import AnnotatedUTR, UTR
+from .utils import Counter, Falsey, balance_shards, cached, connect_db
 
 
 class NoNearbyFeatures(Falsey):
@@ -20,8 +28,21 @@ class PotentialUTRZeroCoverage(Falsey):
     pass
 
 
+class PeaksProgress(collections.namedtuple("PeaksProgress", ["worker", "peaks"])):
+    """
+    Number of peaks annotated by worker since its last report.
+    """
+
+
+class WorkerStatistics(collections.namedtuple("WorkerStatistics", ["worker", "counted", "seconds"])):
+    """
+    Keys counted by each of the statistics Counters of worker, and seconds it spent annotating, sent once it has
+    finished.
+    """
+
+
 class AnnotationsPipeline:
-    def __init__(self, peaks, args, queue=None, db_path=None):
+    def __init__(self, peaks, args, queue=None, db_path=None, bam_basename=None):
         self.no_features_counter = Counter()
         self.zero_coverage_removal_counter = Counter()
         self.peaks = peaks
@@ -29,13 +50,25 @@ class AnnotationsPipeline:
         self.args = args
         self.queue = queue or multiprocessing.Queue()
         self.db_path = db_path
+        self.bam_basename = bam_basename
+        self.worker_seconds = {}
 
     def __enter__(self):
         if not self.db_path:
             raise AnnotationsError("Please instantiate {} with db_path kwarg.".format(self.__class__.__name__))
+        shards = collections.defaultdict(list)
+        for peak in self.peaks:
+            shards[(peak.chr, peak.strand)].append(peak)
+        self.shards = list(shards.items())
+        # Index of the next unclaimed peak per shard, shared between workers.
+        self.cursors = multiprocessing.Array("i", len(self.shards))
+        if not self.args.lazy_coverage_gaps:
+            self._store_coverage_gaps()
+        num_workers = min(self.args.processors, self.total_peaks)
+        home_shards = balance_shards({idx: len(peaks) for idx, (_, peaks) in enumerate(self.shards)}, num_workers)
         self.processes = [
-            self._batch_annotate_strand(batch)
-            for batch in iter_batches(self.peaks, math.ceil(self.total_peaks/self.args.processors))
+            self._batch_annotate_strand(worker, batch)
+            for worker, batch in enumerate(home_shards + [[]] * (num_workers - len(home_shards)))
         ]
         for p in self.processes:
             p.start()
@@ -44,21 +77,152 @@ class AnnotationsPipeline:
 
     def __exit__(self, type, value, traceback):
         self.pbar.close()
+        for p in self.processes:
+            if p.is_alive():
+                p.terminate()
+
+    def iter_results(self):
+        """
+        Yield results from queue as they arrive until all workers have exited, polling the queue for up to
+        RESULTS_POLL_SECONDS at a time and checking for exited workers in between, so that the queue is always drained.
+        Log throughput of each worker as it exits, over the time it spent annotating.
+        """
+        workers = {p.sentinel: worker for worker, p in enumerate(self.processes)}
+        peaks = [0] * len(self.processes)
+        while workers:
+            yield from self._drain_queue(peaks, timeout=constants.RESULTS_POLL_SECONDS)
+            for sentinel in wait(list(workers), timeout=0):
+                # An exited worker has flushed all of its results to the queue, so drain it before accounting.
+                yield from self._drain_queue(peaks)
+                worker = workers.pop(sentinel)
+                p = self.processes[worker]
+                p.join()
+                if p.exitcode != 0:
+                    raise AnnotationsError("Annotation worker {} exited with code {}.".format(worker, p.exitcode))
+                seconds = self.worker_seconds.get(worker, 0)
+                logging.debug("Worker {} annotated {} peaks in {:.1f}s ({:.1f} peaks/s)."
+                              .format(worker, peaks[worker], seconds, peaks[worker] / max(seconds, 1e-6)))
 
-    def _batch_annotate_strand(self, peaks_batch):
+    def _drain_queue(self, peaks, timeout=None):
         """
-        Create multiprocessing Process to handle batch of peaks. Connect to sqlite3 db for each batch to prevent
-        serialization issues.
+        Yield results in queue, adding up progress reports of workers into peaks. Wait up to timeout seconds for the
+        first result if given, otherwise don't block.
+        """
+        block = timeout is not None
+        while True:
+            try:
+                result = self.queue.get(block=block, timeout=timeout)
+            except Empty:
+                return
+            block = False
+            if isinstance(result, PeaksProgress):
+                peaks[result.worker] += result.peaks
+                self.pbar.update(result.peaks)
+            elif isinstance(result, WorkerStatistics):
+                for counter, keys in zip(self.counters, result.counted):
+                    counter.update(keys)
+                self.worker_seconds[result.worker] = result.seconds
+            else:
+                yield result
+
+    @property
+    def counters(self):
+        """
+        Counters of peaks for summary statistics, of this pipeline and of the criteria.
+        """
+        return [self.no_features_counter, self.zero_coverage_removal_counter] + \
+            [f.fails for f in criteria.BATCH_CRITERIA.values()]
+
+    def _batch_annotate_strand(self, worker, home_shards):
+        """
+        Create multiprocessing Process to handle peaks, starting with those of its home shards.
+        """
+        return multiprocessing.Process(target=self._annotate_shards, args=(worker, home_shards))
+
+    def _annotate_shards(self, worker, home_shards):
         """
+        Claim and annotate chunks of peaks of home shards, then steal chunks from the shard with most peaks left until
+        all have been claimed, then send statistics Counters of the worker to the parent. Chunk size adapts to take
+        around PEAK_CHUNK_SECONDS per chunk.
+
+        SPAT truncation points, zero coverage gaps and the annotation index are loaded just for the chromosomes and
+        strands of home shards, then for those of each shard stolen from, the former two memory-mapped from stores
+        shared by all workers. Connect read-only to sqlite3 db for each worker once started, to prevent serialization
+        issues.
+        """
+        worker_started = time.perf_counter()
+        loaded = {self.shards[idx][0] for idx in home_shards}
+        db = AnnotationIndex(connect_db(self.db_path, read_only=True), chrs={chr for chr, _ in loaded})
         truncation_points = {}
         coverage_gaps = {}
+        self._load_shards(loaded, truncation_points, coverage_gaps)
+        chunk_size = constants.PEAK_CHUNK_SIZE
+        while True:
+            shard_idx = next((idx for idx in home_shards if self._peaks_left(idx)), None)
+            if shard_idx is None:
+                shard_idx = max(range(len(self.shards)), key=self._peaks_left)
+                if not self._peaks_left(shard_idx):
+                    break
+            (chr, strand), peaks = self.shards[shard_idx]
+            if (chr, strand) not in loaded:
+                loaded.add((chr, strand))
+                db.load({chr})
+                self._load_shards([(chr, strand)], truncation_points, coverage_gaps)
+            with self.cursors.get_lock():
+                start = self.cursors[shard_idx]
+                end = self.cursors[shard_idx] = min(start + chunk_size, len(peaks))
+            if start == end:
+                continue
+            started = time.perf_counter()
+            self._iter_peaks(db, peaks[start:end], truncation_points, coverage_gaps)
+            self.queue.put(PeaksProgress(worker, end - start))
+            # Scale chunk size towards PEAK_CHUNK_SECONDS, by at most a factor of 2 per chunk.
+            scale = constants.PEAK_CHUNK_SECONDS / max(time.perf_counter() - started, 1e-6)
+            chunk_size = min(max(round(chunk_size * min(max(scale, 0.5), 2)), constants.MIN_PEAK_CHUNK_SIZE),
+                             constants.MAX_PEAK_CHUNK_SIZE)
+        self.queue.put(WorkerStatistics(worker, [counter.keys for counter in self.counters],
+                                        time.perf_counter() - worker_started))
+
+    def _peaks_left(self, shard_idx):
+        return len(self.shards[shard_idx][1]) - self.cursors[shard_idx]
+
+    def _load_shards(self, keys, truncation_points, coverage_gaps):
+        """
+        Load SPAT truncation points and zero coverage gaps per strand for (chromosome, strand) keys of shards, adding
+        to those already loaded.
+        """
+        chrs = collections.defaultdict(set)
+        for chr, strand in keys:
+            chrs[strand].add(chr)
         for strand, symbol in STRAND_MAP.items():
-            truncation_points[symbol] = SPATTruncationPointsDict(json_fn=cached(strand + "_unmapped.json"))
-            coverage_gaps[symbol] = ZeroCoverageIntervalsDict(bed_fn=cached(strand + "_coverage_gaps.bed"))
-        db = connect_db(self.db_path)
-        return multiprocessing.Process(target=self._iter_peaks, args=(db, peaks_batch, truncation_points, coverage_gaps))
+            if not chrs[symbol]:
+                continue
+            strand_truncation_points = SPATTruncationPointsDict(
+                spat_fn=None if self.args.skip_soft_clip else cached(strand + "_truncation_points.npy"), chrs=chrs[symbol])
+            strand_coverage_gaps = self._load_coverage_gaps(strand, chrs[symbol])
+            if symbol in truncation_points:
+                truncation_points[symbol].update(strand_truncation_points)
+                coverage_gaps[symbol].update(strand_coverage_gaps)
+            else:
+                truncation_points[symbol] = strand_truncation_points
+                coverage_gaps[symbol] = strand_coverage_gaps
+
+    def _store_coverage_gaps(self):
+        """
+        Parse zero coverage gaps BED file of each strand once, into binary stores that workers memory-map.
+        """
+        for strand in STRAND_MAP:
+            ZeroCoverageIntervalsDict(bed_fn=cached(strand + "_coverage_gaps.bed")).write(
+                cached(strand + "_coverage_gaps.npy"))
+
+    def _load_coverage_gaps(self, strand, chrs=None):
+        if self.args.lazy_coverage_gaps:
+            return LazyZeroCoverageIntervalsDict(bam_fn=cached(self.bam_basename + ".%s.bam" % strand))
+        return ZeroCoverageIntervalsDict(store_fn=cached(strand + "_coverage_gaps.npy"), chrs=chrs)
 
     def _iter_peaks(self, db, peaks_batch, truncation_points, coverage_gaps):
+        if self.args.sweep or self.args.batch_criteria:
+            return self._sweep_peaks(db, peaks_batch, truncation_points, coverage_gaps)
         for peak in peaks_batch:
             self.annotate_utr_for_peak(
                 db,
@@ -74,6 +238,10 @@ class AnnotationsPipeline:
             strand=strand if not self.args.no_strand_overlap else None,
             featuretype=featuretype)
         )
+        return self._order_genes(features, strand)
+
+    @staticmethod
+    def _order_genes(features, strand):
         return sorted(features, key=lambda x: x.start, reverse=False if strand == "+" else True)
     
     @staticmethod
@@ -93,11 +261,10 @@ class AnnotationsPipeline:
         If so, add to multiprocessing Queue.
 
         Args:
-            db (gffutils.interface.FeatureDB)
+            db (gffutils.interface.FeatureDB or AnnotationIndex)
             truncation_points (SPATTruncationPointsDict)
             coverage_gaps (ZeroCoverageIntervalsDict)
         """
-        utr_found = False
         genes = self._filter_db(
             db,
             peak.chr,
@@ -106,102 +273,279 @@ class AnnotationsPipeline:
             peak.strand,
             constants.FeatureTypes.Gene + constants.FeatureTypes.NonCodingGene
         ) or []
-        if genes:
-            for idx, gene in enumerate(genes):
+        for result in self._annotate_utr_for_genes(db, peak, genes, lambda gene: self._get_ordered_transcripts(db, gene),
+                                                   truncation_points, coverage_gaps):
+            self.queue.put(result)
+
+    def _sweep_peaks(self, db, peaks_batch, truncation_points, coverage_gaps):
+        """
+        Alternative to _iter_peaks, sweeping through peaks and the genes of AnnotationIndex db together, sorted per
+        chromosome and strand. Results are put in the queue in order of peaks_batch, per chromosome and strand.
+
+        Args:
+            truncation_points (dict): SPATTruncationPointsDict per strand
+            coverage_gaps (dict): ZeroCoverageIntervalsDict per strand
+        """
+        shards = collections.defaultdict(list)
+        for peak in peaks_batch:
+            shards[(peak.chr, peak.strand)].append(peak)
+        for (chr, strand), peaks in shards.items():
+            # Each shard is annotated against the stores of its own strand only.
+            strand_truncation_points, strand_coverage_gaps = truncation_points.get(strand), coverage_gaps.get(strand)
+            transcripts = {}
+
+            def get_transcripts(gene):
+                if gene.id not in transcripts:
+                    transcripts[gene.id] = list(self._get_ordered_transcripts(db, gene))
+                return (copy.copy(t) for t in transcripts[gene.id])
+
+            if self.args.batch_criteria:
+                # Transcripts of genes the sweep has passed are still needed once criteria are evaluated.
+                neighbourhoods = list(self._iter_neighbourhoods(db, chr, strand, peaks))
+                results = self._annotate_utrs_batch(db, chr, strand, peaks, neighbourhoods, get_transcripts,
+                                                    strand_truncation_points, strand_coverage_gaps)
+            else:
+                results = [None] * len(peaks)
+                for idx, neighbourhood in self._iter_neighbourhoods(
+                        db, chr, strand, peaks, evict=lambda gene: transcripts.pop(gene.id, None)):
+                    results[idx] = self._annotate_utr_for_genes(db, peaks[idx], neighbourhood, get_transcripts,
+                                                                strand_truncation_points, strand_coverage_gaps)
+            for result in itertools.chain.from_iterable(results):
+                self.queue.put(result)
+
+    def _iter_neighbourhoods(self, db, chr, strand, peaks, evict=None):
+        """
+        Yield index of each of peaks on chr and strand, in order of start, with copies of the genes in its region
+        ordered as by _filter_db. Genes of AnnotationIndex db enter a heap of active genes as the sweep reaches them and
+        leave it, passed to optional evict callable, once it has passed their end, so that the region of each peak is
+        found without querying the index.
+        """
+        if not peaks:
+            return
+        genes = db.iter_genes(chr, strand if not self.args.no_strand_overlap else None,
+                              min(peak.start for peak in peaks) - self.args.max_distance)
+        pending = next(genes, None)
+        active = []
+        for idx in sorted(range(len(peaks)), key=lambda x: peaks[x].start):
+            peak = peaks[idx]
+            start, end = peak.start - self.args.max_distance, peak.end + self.args.max_distance
+            while pending is not None and pending.start <= end:
+                heapq.heappush(active, (pending.end, pending.file_order, pending))
+                pending = next(genes, None)
+            while active and active[0][0] < start:
+                gene = heapq.heappop(active)[2]
+                if evict:
+                    evict(gene)
+            yield idx, self._order_genes(
+                sorted((copy.copy(g) for _, _, g in active if AnnotationIndex.in_region(g, start, end)),
+                       key=lambda x: (x.start, x.file_order)),
+                strand)
+
+    def _annotate_utrs_batch(self, db, chr, strand, peaks, neighbourhoods, get_transcripts, truncation_points,
+                             coverage_gaps):
+        """
+        Batch alternative to _annotate_utr_for_genes over peaks on chr and strand with their (index, neighbourhood)
+        pairs, evaluating criteria at once over arrays of peaks and the outermost transcripts of their genes. Failures
+        are tracked in the same order as the per-peak evaluation, so that criteria fails are counted alike. Return
+        list of results to add to multiprocessing Queue per peak.
+        """
+        pairs = []
+        bounds = []
+        for idx, genes in neighbourhoods:
+            for gene_idx, gene in enumerate(genes):
                 # Skip disqualifying genes
-                if gene.featuretype not in constants.FeatureTypes.Gene or gene.strand != peak.strand:
+                if gene.featuretype not in constants.FeatureTypes.Gene or gene.strand != strand:
                     continue
-                transcripts = self._get_ordered_transcripts(db, gene)
                 # Take outermost transcript
-                try:
-                    transcript = next(transcripts)
-                except StopIteration:
+                transcript = next(get_transcripts(gene), None)
+                if transcript is None:
                     continue
-                try:
-                    # First, make the transcript 3' extremity match
-                    # what will not be reannotated depending on override/extend
-                    criteria.assert_whether_utr_already_annotated(peak, transcript, db,
-                                                                  self.args.override_utr, self.args.extend_utr)
-                    # Stop if the peak is already within the existing transcript
-                    criteria.assert_peak_not_a_subset_of_transcript(peak, transcript)
-                    utr = UTR(start=peak.start, end=peak.end)
-                    # Modify the 5' end of utr to match 3' end of transcript
-                    criteria.assert_3_prime_end_and_truncate(peak, transcript, utr)
-                    if len(genes) > 1:
-                        next_gene_idx = idx + 1
-                        next_gene = genes[next_gene_idx % len(genes)]
-                        while next_gene != gene:
-                            for next_transcript in self._get_ordered_transcripts(db, next_gene):
-                                # Stop if the transcript is contained within transcript of another gene
-                                criteria.assert_transcript_not_a_subset_of_adjacent_gene(transcript, next_transcript, next_gene)
-                                # Truncate to avoid overlap with another gene
-                                criteria.truncate_to_adjacent_transcript(peak, transcript, utr, next_transcript, next_gene,
-                                                                    self.args.five_prime_ext)
-                            next_gene_idx += 1
-                            next_gene = genes[next_gene_idx % len(genes)]
-                except criteria.CriteriaFailure as e:
-                    logging.debug("%s - %s" % (type(e).__name__, e))
-                else:
-                    colour = AnnotationColour.Extended
-                    intersect = utr.range.intersection(map(int, sorted(truncation_points[peak.chr], key=int))) \
-                        if peak.chr in truncation_points else None
-                    if peak.strand == "+":
-                        gaps = coverage_gaps.filter(peak.chr, utr.end)
-                        try:
-                            gap_edge = min([g.start for g in gaps])
-                        except ValueError:
-                            pass
-                        else:
-                            # If gap_edge is lower than transcript.end
-                            # We set utr.end to transcript.end
-                            # This will generate a utr of size 0
-                            utr.end = max(transcript.end, gap_edge - 1)
-                            colour = AnnotationColour.TruncatedZeroCoverage
-                    else:
-                        gaps = coverage_gaps.filter(peak.chr, utr.start)
-                        try:
-                            gap_edge = max([g.end for g in gaps])
-                        except ValueError:
-                            pass
-                        else:
-                            # If gap_edge is higher than transcript.end
-                            # We set utr.start to transcript.start
-                            # This will generate a utr of size 0
-                            utr.start = min(transcript.start, gap_edge + 1)
-                            colour = AnnotationColour.TruncatedZeroCoverage
-                    if intersect:
-                        if peak.strand == "+":
-                            utr.end = max(intersect)
-                        else:
-                            utr.start = min(intersect)
-                        colour = AnnotationColour.ExtendedWithSPAT
-                    if utr.is_valid():
-                        logging.debug("Peak {} corresponds to 3' UTR {} of gene {}".upper().format(peak.name, utr, gene.id))
-                        utr.generate_feature(gene, transcript, db, colour, self.args.gtf_in)
-                        features = features_dict_for_gene(db, gene, transcript)
-                        features.update({"utr": utr.feature})
-                        if peak.strand == "+":
-                            gene.end = transcript.end = utr.end
-                        else:
-                            gene.start = transcript.start = utr.start
-                        self.queue.put({gene.id: features})
-                        utr_found = True
-                    else:
-                        if utr.length == 0:
-                            logging.debug(
-                                "Peak {} corresponds to potential 3' UTR that was removed due to zero read coverage."
-                                .format(peak.name))
-                            self.queue.put(PotentialUTRZeroCoverage())
-                            self.zero_coverage_removal_counter.add(peak.name)
-                        else:
-                            logging.error(
-                                "Peak {} produced abnormal 3' UTR {} for gene {}. "
-                                "This is a bug, please report at https://github.com/haessar/peaks2utr/issues."
-                                .format(peak.name, utr, gene.id))
+                existing_utrs = list(db.children(transcript, featuretype=constants.FeatureTypes.ThreePrimeUTR))
+                if len(existing_utrs) > 1:
+                    logging.debug("Multiple existing 3' UTRs found for transcript %s" % transcript.id)
+                pairs.append((idx, gene_idx, gene, transcript))
+                bounds.append((peaks[idx].start, peaks[idx].end, transcript.start, transcript.end,
+                               min((u.start for u in existing_utrs), default=-1),
+                               max((u.end for u in existing_utrs), default=-1)))
+        codes, transcript_starts, transcript_ends, utr_starts, utr_ends = criteria.evaluate_batch(
+            strand, *np.array(bounds, dtype=np.int64).reshape(-1, 6).T, self.args.override_utr, self.args.extend_utr)
+        # Truncate to avoid overlap with other genes, for pairs passing criteria so far.
+        neighbourhoods = dict(neighbourhoods)
+        for pair_idx in np.flatnonzero(codes == criteria.PASSED).tolist():
+            idx, gene_idx, gene, transcript = pairs[pair_idx]
+            transcript.start, transcript.end = int(transcript_starts[pair_idx]), int(transcript_ends[pair_idx])
+            utr = UTR(start=int(utr_starts[pair_idx]), end=int(utr_ends[pair_idx]))
+            try:
+                self._truncate_to_adjacent_genes(peaks[idx], gene, transcript, utr,
+                                                 self._adjacent_genes(neighbourhoods[idx], gene_idx), get_transcripts)
+            except criteria.CriteriaFailure as e:
+                logging.debug("%s - %s" % (type(e).__name__, e))
+                codes[pair_idx] = criteria.TRANSCRIPT_SUBSET_OF_ADJACENT_GENE
+            else:
+                utr_starts[pair_idx], utr_ends[pair_idx] = utr.start, utr.end
+        # Truncate to SPAT truncation points or zero coverage gaps.
+        colours = np.full(len(pairs), AnnotationColour.Extended, dtype=object)
+        passed = codes == criteria.PASSED
+        if strand == "+":
+            points = truncation_points.max_in_ranges(chr, utr_starts, utr_ends)
+            gap_edges = coverage_gaps.gap_edges(chr, utr_ends[passed])
+            gaps = np.zeros(len(pairs), dtype=bool)
+            gaps[passed] = gap_edges >= 0
+            utr_ends[gaps] = np.maximum(transcript_ends[gaps], gap_edges[gap_edges >= 0] - 1)
         else:
+            points = truncation_points.min_in_ranges(chr, utr_starts, utr_ends)
+            gap_edges = coverage_gaps.gap_edges(chr, utr_starts[passed], reverse=True)
+            gaps = np.zeros(len(pairs), dtype=bool)
+            gaps[passed] = gap_edges >= 0
+            utr_starts[gaps] = np.minimum(transcript_starts[gaps], gap_edges[gap_edges >= 0] + 1)
+        colours[gaps] = AnnotationColour.TruncatedZeroCoverage
+        spat = passed & (points >= 0)
+        (utr_ends if strand == "+" else utr_starts)[spat] = points[spat]
+        colours[spat] = AnnotationColour.ExtendedWithSPAT
+        # Track failures and collect results in order of peaks, then genes.
+        results = [[] for _ in peaks]
+        for idx, genes in neighbourhoods.items():
+            if not genes:
+                logging.debug("No features found near peak %s" % peaks[idx].name)
+                self.no_features_counter.add(peaks[idx].name)
+                results[idx].append(NoNearbyFeatures())
+        for pair_idx, (idx, _, gene, transcript) in enumerate(pairs):
+            code = codes[pair_idx]
+            if code == criteria.PASSED:
+                utr = UTR(start=int(utr_starts[pair_idx]), end=int(utr_ends[pair_idx]))
+                result = self._utr_result(peaks[idx], gene, transcript, utr, colours[pair_idx])
+                if result is not None:
+                    results[idx].append(result)
+            elif code in criteria.BATCH_CRITERIA:
+                criteria.BATCH_CRITERIA[code].fails.add(peaks[idx].name)
+        for idx, genes in neighbourhoods.items():
+            if genes and not any(isinstance(result, AnnotatedUTR) for result in results[idx]):
+                results[idx].append(None)
+        return results
+
+    def _annotate_utr_for_genes(self, db, peak, genes, get_transcripts, truncation_points, coverage_gaps):
+        """
+        Apply criteria to determine if 3' UTR exists for each of the genes in region of given peak, ordered as by
+        _filter_db. Return list of results to add to multiprocessing Queue.
+
+        Args:
+            get_transcripts (callable): Return iterator of transcripts of gene, outermost first.
+        """
+        if not genes:
             logging.debug("No features found near peak %s" % peak.name)
-            self.queue.put(NoNearbyFeatures())
             self.no_features_counter.add(peak.name)
+            return [NoNearbyFeatures()]
+        results = []
+        for idx, gene in enumerate(genes):
+            # Skip disqualifying genes
+            if gene.featuretype not in constants.FeatureTypes.Gene or gene.strand != peak.strand:
+                continue
+            # Take outermost transcript
+            transcript = next(get_transcripts(gene), None)
+            if transcript is None:
+                continue
+            result = self._annotate_utr_for_gene(db, peak, gene, transcript, self._adjacent_genes(genes, idx),
+                                                 get_transcripts, truncation_points, coverage_gaps)
+            if result is not None:
+                results.append(result)
+        if not any(isinstance(result, AnnotatedUTR) for result in results):
+            results.append(None)
+        return results
+
+    @staticmethod
+    def _adjacent_genes(genes, idx):
+        """
+        Genes adjacent to genes[idx], in order following it.
+        """
+        gene = genes[idx]
+        return itertools.takewhile(lambda x: x != gene, (genes[(idx + i) % len(genes)] for i in range(1, len(genes) + 1)))
+
+    def _truncate_to_adjacent_genes(self, peak, gene, transcript, utr, adjacent_genes, get_transcripts):
+        for next_gene in adjacent_genes:
+            for next_transcript in get_transcripts(next_gene):
+                # Stop if the transcript is contained within transcript of another gene
+                criteria.assert_transcript_not_a_subset_of_adjacent_gene(transcript, next_transcript, next_gene)
+                # Truncate to avoid overlap with another gene
+                criteria.truncate_to_adjacent_transcript(peak, transcript, utr, next_transcript, next_gene,
+                                                         self.args.five_prime_ext)
+
+    def _annotate_utr_for_gene(self, db, peak, gene, transcript, adjacent_genes, get_transcripts, truncation_points,
+                               coverage_gaps):
+        """
+        Apply criteria to determine if 3' UTR exists for gene, given its outermost transcript. Return features of
+        gene including its new 3' UTR, PotentialUTRZeroCoverage if the UTR was removed due to zero read coverage, or
+        None.
+        """
+        try:
+            # First, make the transcript 3' extremity match
+            # what will not be reannotated depending on override/extend
+            criteria.assert_whether_utr_already_annotated(peak, transcript, db,
+                                                          self.args.override_utr, self.args.extend_utr)
+            # Stop if the peak is already within the existing transcript
+            criteria.assert_peak_not_a_subset_of_transcript(peak, transcript)
+            utr = UTR(start=peak.start, end=peak.end)
+            # Modify the 5' end of utr to match 3' end of transcript
+            criteria.assert_3_prime_end_and_truncate(peak, transcript, utr)
+            self._truncate_to_adjacent_genes(peak, gene, transcript, utr, adjacent_genes, get_transcripts)
+        except criteria.CriteriaFailure as e:
+            logging.debug("%s - %s" % (type(e).__name__, e))
             return
-        if not utr_found:
-            self.queue.put(None)
+        colour = AnnotationColour.Extended
+        if peak.strand == "+":
+            truncation_point = truncation_points.max_in_range(peak.chr, utr.start, utr.end)
+        else:
+            truncation_point = truncation_points.min_in_range(peak.chr, utr.start, utr.end)
+        if peak.strand == "+":
+            gaps = coverage_gaps.filter(peak.chr, utr.end)
+            try:
+                gap_edge = min([g.start for g in gaps])
+            except ValueError:
+                pass
+            else:
+                # If gap_edge is lower than transcript.end
+                # We set utr.end to transcript.end
+                # This will generate a utr of size 0
+                utr.end = max(transcript.end, gap_edge - 1)
+                colour = AnnotationColour.TruncatedZeroCoverage
+        else:
+            gaps = coverage_gaps.filter(peak.chr, utr.start)
+            try:
+                gap_edge = max([g.end for g in gaps])
+            except ValueError:
+                pass
+            else:
+                # If gap_edge is higher than transcript.end
+                # We set utr.start to transcript.start
+                # This will generate a utr of size 0
+                utr.start = min(transcript.start, gap_edge + 1)
+                colour = AnnotationColour.TruncatedZeroCoverage
+        if truncation_point is not None:
+            if peak.strand == "+":
+                utr.end = truncation_point
+            else:
+                utr.start = truncation_point
+            colour = AnnotationColour.ExtendedWithSPAT
+        return self._utr_result(peak, gene, transcript, utr, colour)
+
+    def _utr_result(self, peak, gene, transcript, utr, colour):
+        """
+        Return AnnotatedUTR record of the new 3' UTR of gene, PotentialUTRZeroCoverage if the UTR was removed due to
+        zero read coverage, or None.
+        """
+        if utr.is_valid():
+            logging.debug("Peak {} corresponds to 3' UTR {} of gene {}".upper().format(peak.name, utr, gene.id))
+            if peak.strand == "+":
+                gene.end = transcript.end = utr.end
+            else:
+                gene.start = transcript.start = utr.start
+            return AnnotatedUTR(gene.id, transcript.id, int(utr.start), int(utr.end), colour)
+        if utr.length == 0:
+            logging.debug(
+                "Peak {} corresponds to potential 3' UTR that was removed due to zero read coverage."
+                .format(peak.name))
+            self.zero_coverage_removal_counter.add(peak.name)
+            return PotentialUTRZeroCoverage()
+        logging.error(
+            "Peak {} produced abnormal 3' UTR {} for gene {}. "
+            "This is a bug, please report at https://github.com/haessar/peaks2utr/issues."
+            .format(peak.name, utr, gene.id))
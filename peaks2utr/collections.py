@@ -1,45 +1,170 @@
+import bisect
 import collections
-from collections.abc import Sequence
+from collections.abc import MutableMapping, Sequence
 import copy
 import csv
-import json
+import heapq
+import io
+import itertools
+import os
+import pickle
+import sqlite3
 
 import gffutils
+import numpy as np
+import pysam
 
 from . import constants
+from .coverage import aligned_blocks, low_coverage_intervals
+from .formatting import FeatureSerializer
 from .models import Peak
+from .utils import read_records, read_truncation_points, write_records
 
 
 class AnnotationsDict(collections.UserDict):
     """
-    Dictionary of features per gene id.
+    Dictionary of features per gene id. New 3' UTRs are held as AnnotatedUTR records per gene id until merged.
+    Counts of features per (featuretype, source), and indexes of gene ids per featuretype and per source, are kept as
+    features are set, of features as set rather than as converted to the output dialect.
     """
+    INDEXED_ATTRIBUTES = ["featuretype", "source"]
+
     def __init__(self, dict=None, args=None):
+        self.utrs = {}
+        self.counts = collections.Counter()
+        self._index = {attr: collections.defaultdict(collections.Counter) for attr in self.INDEXED_ATTRIBUTES}
         super().__init__(dict)
-        if args:
-            self.gtf_in = args.gtf_in
-            self.gtf_out = args.gtf_out
+        self.gtf_in = args.gtf_in if args else False
+        self.gtf_out = args.gtf_out if args else False
+        self.serializer = FeatureSerializer()
 
     def __setitem__(self, gene, new_features):
         existing_features = self.get(gene)
         if existing_features:
-            if new_features["utr"].range.issubset(existing_features["utr"].range):
+            if new_features["utr"].interval.issubset(existing_features["utr"].interval):
                 return
+            self._index_features(gene, existing_features, -1)
         self.data[gene] = new_features
+        self._index_features(gene, new_features)
+
+    def __delitem__(self, gene):
+        self._index_features(gene, self.data[gene], -1)
+        del self.data[gene]
+
+    def _index_features(self, gene, features, increment=1):
+        for f in features.values():
+            counters = [(self.counts, (f.featuretype, f.source))] + \
+                [(index[getattr(f, attr)], gene) for attr, index in self._index.items()]
+            for counter, key in counters:
+                counter[key] += increment
+                if not counter[key]:
+                    del counter[key]
+
+    def close(self):
+        """
+        Release resources held by annotations, of which there are none unless stored on disk.
+        """
+
+    def add_utr(self, annotated_utr):
+        """
+        Hold AnnotatedUTR record, unless an existing one for its gene already covers it.
+        """
+        existing_utr = self.utrs.get(annotated_utr.gene_id)
+        if existing_utr and annotated_utr.interval.issubset(existing_utr.interval):
+            return
+        self.utrs[annotated_utr.gene_id] = annotated_utr
 
     def iter_feature_strings(self):
         for gid, features in self.data.items():
-            for _, f in features.items():
-                # gene features are redundant in GTF output
-                if self.gtf_out and f.featuretype in constants.FeatureTypes.Gene:
-                    continue
-                formatted_f = self._apply_feature_dialect(f, gid)
-                yield str(formatted_f) + '\n'
-                # exon matching three_prime_UTR for GTF output
-                if self.gtf_out and f.source == __package__ and f.featuretype in constants.FeatureTypes.ThreePrimeUTR:
-                    exon = copy.copy(formatted_f)
-                    exon.featuretype = constants.FeatureTypes.Exon[0]
-                    yield str(exon) + '\n'
+            for f, featuretype in self._iter_formatted_features(gid, features):
+                yield self.serializer(f, featuretype)
+
+    def iter_sorted_feature_strings(self):
+        """
+        Yield feature strings as iter_feature_strings, with genes sorted by seqid and position and the features of each
+        in hierarchy order, as by `gt gff3 -sort -retainids`. GFF3 output is preceded by version and sequence-region
+        directives, and the features of each gene are followed by a "###" directive. Only the sort keys of genes are
+        held in memory besides the features themselves. GTF output was never sorted by gt, so is left in order.
+        """
+        if self.gtf_out:
+            yield from self.iter_feature_strings()
+            return
+        yield "##gff-version 3\n"
+        regions = self._sequence_regions()
+        for seqid in sorted(regions):
+            yield "##sequence-region   %s %d %d\n" % (seqid, *regions[seqid])
+        for gid, features in self._iter_sorted_genes():
+            for f, featuretype in self._hierarchy_order(list(self._iter_formatted_features(gid, features))):
+                yield self.serializer(f, featuretype)
+            yield "###\n"
+
+    def _sequence_regions(self):
+        """
+        Return dictionary of (start, end) spanning features per seqid.
+        """
+        regions = {}
+        for features in self.data.values():
+            for f in features.values():
+                start, end = regions.get(f.seqid, (f.start, f.end))
+                regions[f.seqid] = (min(start, f.start), max(end, f.end))
+        return regions
+
+    def _iter_sorted_genes(self):
+        """
+        Yield (gene id, features) sorted by seqid and position of gene, otherwise in order of insertion.
+        """
+        genes = sorted(self.data, key=lambda gid: (self.data[gid]["gene"].seqid, self.data[gid]["gene"].start,
+                                                   self.data[gid]["gene"].end))
+        for gid in genes:
+            yield gid, self.data[gid]
+
+    def _iter_formatted_features(self, gene_id, features):
+        """
+        Yield (feature, featuretype to output it as, or None) for features of gene in output dialect.
+        """
+        for _, f in features.items():
+            # gene features are redundant in GTF output
+            if self.gtf_out and f.featuretype in constants.FeatureTypes.Gene:
+                continue
+            formatted_f = self._apply_feature_dialect(f, gene_id)
+            yield formatted_f, None
+            # exon matching three_prime_UTR for GTF output
+            if self.gtf_out and f.source == __package__ and f.featuretype in constants.FeatureTypes.ThreePrimeUTR:
+                yield formatted_f, constants.FeatureTypes.Exon[0]
+
+    def _hierarchy_order(self, features):
+        """
+        Order (feature, featuretype) pairs of a gene depth-first from those without a parent among them, each followed
+        by its children sorted by position. A child of several parents follows the first of them to be visited.
+        """
+        def node_ids(f):
+            return f.attributes.get("ID", [])
+
+        def parent_ids(f):
+            return f.attributes.get("Parent", [])
+
+        ids = {node_id for f, _ in features for node_id in node_ids(f)}
+        roots = []
+        children = collections.defaultdict(list)
+        for pair in sorted(features, key=lambda x: (x[0].start, x[0].end)):
+            parents = [p for p in parent_ids(pair[0]) if p in ids and p not in node_ids(pair[0])]
+            for p in parents:
+                children[p].append(pair)
+            if not parents:
+                roots.append(pair)
+        ordered = []
+        visited = set()
+        stack = list(reversed(roots))
+        while stack:
+            pair = stack.pop()
+            if id(pair) in visited:
+                continue
+            visited.add(id(pair))
+            ordered.append(pair)
+            stack.extend(reversed([c for node_id in node_ids(pair[0]) for c in children[node_id]]))
+        # Features only reachable through a cycle of parents
+        ordered.extend(pair for pair in features if id(pair) not in visited)
+        return ordered
 
     @staticmethod
     def _apply_gff_dialect(feature, attrs):
@@ -89,22 +214,184 @@ class AnnotationsDict(collections.UserDict):
             feature.attributes = gffutils.attributes.Attributes(**attrs)
         return feature
 
+    @staticmethod
+    def _matches(value, obj):
+        if isinstance(obj, Sequence) and not isinstance(obj, str):
+            return value in obj
+        return value == obj
+
     def filter(self, **kwargs):
         """
-        Filter features for given attributes.
+        Filter features for all given attributes, each matching a value or any of a sequence of values. Only genes in
+        the indexes of featuretype and source given are scanned.
         """
-        all_features = [vv for v in self.values() for vv in v.values()]
+        genes = None
         for attr, obj in kwargs.items():
-            if isinstance(obj, Sequence) and not isinstance(obj, str):
-                filtered_features = [f for f in all_features if getattr(f, attr) in obj]
-            else:
-                filtered_features = [f for f in all_features if getattr(f, attr) == obj]
-        return filtered_features
+            if attr in self._index:
+                values = obj if isinstance(obj, Sequence) and not isinstance(obj, str) else [obj]
+                attr_genes = set().union(*(self._index[attr].get(value, ()) for value in values))
+                genes = attr_genes if genes is None else genes & attr_genes
+        return [f for gene in (self.data if genes is None else genes) for f in self.data[gene].values()
+                if all(self._matches(getattr(f, attr), obj) for attr, obj in kwargs.items())]
+
+    def count(self, **kwargs):
+        """
+        Count features for given featuretype and / or source as filter, from counts kept rather than scanning genes.
+        """
+        if not set(kwargs).issubset(self.INDEXED_ATTRIBUTES):
+            return len(self.filter(**kwargs))
+        return sum(n for (featuretype, source), n in self.counts.items()
+                   if self._matches(featuretype, kwargs.get("featuretype", featuretype))
+                   and self._matches(source, kwargs.get("source", source)))
+
+
+class DiskAnnotationsDict(AnnotationsDict):
+    """
+    AnnotationsDict with features of genes in a FeatureStore on disk rather than all held in memory, streaming sorted
+    output from it.
+    """
+    def __init__(self, dict=None, args=None, store_fn=None, cache_size=constants.FEATURE_STORE_CACHE_SIZE):
+        super().__init__(args=args)
+        self.data = FeatureStore(store_fn, cache_size)
+        if dict is not None:
+            self.update(dict)
+
+    def _sequence_regions(self):
+        return self.data.sequence_regions()
+
+    def _iter_sorted_genes(self):
+        return self.data.iter_sorted()
+
+    def close(self):
+        self.data.close()
+
+
+class FeatureStore(MutableMapping):
+    """
+    Mapping of features dicts per gene id pickled to a sqlite db at db_fn, in front of which the cache_size most
+    recently used are held in memory. Features are written to db as they are set, so changes to those got from the
+    store are not kept. Positions of genes and sequence regions of their features are stored alongside for sorted
+    output. Closing the store, or leaving it as a context manager, deletes db_fn.
+    """
+    def __init__(self, db_fn, cache_size=constants.FEATURE_STORE_CACHE_SIZE):
+        self.db_fn = db_fn
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        # Dialects are shared between features, so are pickled once per store rather than with each of them.
+        self._dialects = []
+        if os.path.exists(db_fn):
+            os.remove(db_fn)
+        self.conn = sqlite3.connect(db_fn)
+        self.conn.executescript("""
+            PRAGMA journal_mode = OFF;
+            PRAGMA synchronous = OFF;
+            CREATE TABLE genes (id TEXT PRIMARY KEY, seqid TEXT, start INTEGER, end INTEGER, features BLOB);
+            CREATE TABLE regions (gene_id TEXT, seqid TEXT, start INTEGER, end INTEGER);
+            CREATE INDEX regions_gene_id ON regions (gene_id);
+        """)
+
+    def __getitem__(self, gene):
+        if gene in self.cache:
+            self.cache.move_to_end(gene)
+            return self.cache[gene]
+        row = self.conn.execute("SELECT features FROM genes WHERE id = ?", (gene,)).fetchone()
+        if row is None:
+            raise KeyError(gene)
+        features = self._loads(row[0])
+        self._cache(gene, features)
+        return features
+
+    def __setitem__(self, gene, features):
+        # Upsert rather than replace, keeping order of insertion as a dict.
+        self.conn.execute(
+            "INSERT INTO genes VALUES (?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET seqid = excluded.seqid, "
+            "start = excluded.start, end = excluded.end, features = excluded.features",
+            (gene, features["gene"].seqid, features["gene"].start, features["gene"].end, self._dumps(features)))
+        regions = {}
+        for f in features.values():
+            start, end = regions.get(f.seqid, (f.start, f.end))
+            regions[f.seqid] = (min(start, f.start), max(end, f.end))
+        self.conn.execute("DELETE FROM regions WHERE gene_id = ?", (gene,))
+        self.conn.executemany("INSERT INTO regions VALUES (?, ?, ?, ?)",
+                              [(gene, seqid, start, end) for seqid, (start, end) in regions.items()])
+        self._cache(gene, features)
+
+    def __delitem__(self, gene):
+        if not self.conn.execute("DELETE FROM genes WHERE id = ?", (gene,)).rowcount:
+            raise KeyError(gene)
+        self.conn.execute("DELETE FROM regions WHERE gene_id = ?", (gene,))
+        self.cache.pop(gene, None)
+
+    def __contains__(self, gene):
+        return gene in self.cache or \
+            self.conn.execute("SELECT 1 FROM genes WHERE id = ?", (gene,)).fetchone() is not None
+
+    def __iter__(self):
+        for gene, in self.conn.execute("SELECT id FROM genes ORDER BY rowid"):
+            yield gene
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM genes").fetchone()[0]
+
+    def _cache(self, gene, features):
+        self.cache[gene] = features
+        self.cache.move_to_end(gene)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def _dialect_id(self, obj):
+        if isinstance(obj, dict) and "fmt" in obj and "order" in obj:
+            for idx, dialect in enumerate(self._dialects):
+                if obj is dialect or obj == dialect:
+                    return idx
+            self._dialects.append(obj)
+            return len(self._dialects) - 1
+        return None
+
+    def _dumps(self, features):
+        buf = io.BytesIO()
+        pickler = pickle.Pickler(buf, pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = self._dialect_id
+        pickler.dump(features)
+        return buf.getvalue()
+
+    def _loads(self, data):
+        unpickler = pickle.Unpickler(io.BytesIO(data))
+        unpickler.persistent_load = self._dialects.__getitem__
+        return unpickler.load()
+
+    def iter_sorted(self):
+        """
+        Yield (gene id, features) sorted by seqid and position of gene, otherwise in order of insertion, read from db
+        in a single pass.
+        """
+        for gene, data in self.conn.execute("SELECT id, features FROM genes ORDER BY seqid, start, end, rowid"):
+            yield gene, self._loads(data)
+
+    def sequence_regions(self):
+        """
+        Return dictionary of (start, end) spanning features per seqid.
+        """
+        return {seqid: (start, end) for seqid, start, end in
+                self.conn.execute("SELECT seqid, MIN(start), MAX(end) FROM regions GROUP BY seqid")}
+
+    def close(self):
+        self.cache.clear()
+        self.conn.close()
+        if os.path.exists(self.db_fn):
+            os.remove(self.db_fn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
 
 
 class ZeroCoverageIntervalsDict(collections.UserDict):
     """
-    Dictionary of zero coverage intervals per chromosome from parsed BED file.
+    Dictionary of zero coverage intervals per chromosome from parsed BED file, or memory-mapped from a binary store
+    written by write, held as (starts, ends) arrays sorted by start.
     """
     class Interval:
         """
@@ -115,38 +402,222 @@ class ZeroCoverageIntervalsDict(collections.UserDict):
             self.start = int(start) + 1
             self.end = int(end)
 
-    def __init__(self, dict=None, bed_fn=None):
+    def __init__(self, dict=None, bed_fn=None, chrs=None, store_fn=None):
         super().__init__(dict)
+        self._disjoint = {}
+        if store_fn:
+            for chr, records in read_records(store_fn).items():
+                if chrs is None or chr in chrs:
+                    self.data[chr] = (records["start"], records["end"])
         if bed_fn:
             with open(bed_fn, 'r') as f:
-                for line in f.readlines():
-                    chr, start, end = line.strip().split('\t')
-                    if chr not in self.data:
-                        self.data[chr] = []
-                    self.data[chr].append(self.Interval(start, end))
+                fields = f.read().split()
+            if not fields:
+                return
+            chr_fields = np.array(fields[0::3])
+            starts = np.array(fields[1::3], dtype=np.int64) + 1
+            ends = np.array(fields[2::3], dtype=np.int64)
+            intervals = collections.defaultdict(list)
+            # Split into blocks of consecutive lines on the same chromosome.
+            bounds = [0, *(np.flatnonzero(chr_fields[1:] != chr_fields[:-1]) + 1), len(chr_fields)]
+            for block_start, block_end in zip(bounds[:-1], bounds[1:]):
+                chr = str(chr_fields[block_start])
+                if chrs is None or chr in chrs:
+                    intervals[chr].append((starts[block_start:block_end], ends[block_start:block_end]))
+            for chr, blocks in intervals.items():
+                chr_starts = np.concatenate([b[0] for b in blocks])
+                chr_ends = np.concatenate([b[1] for b in blocks])
+                order = np.argsort(chr_starts, kind="stable")
+                self.data[chr] = (chr_starts[order], chr_ends[order])
+
+    def write(self, fn):
+        """
+        Write intervals to binary store fn, to be memory-mapped read-only by any number of processes.
+        """
+        records = {}
+        for chr, (starts, ends) in self.items():
+            records[chr] = np.empty(len(starts), dtype=constants.COVERAGE_GAPS_DTYPE)
+            records[chr]["start"] = starts
+            records[chr]["end"] = ends
+        write_records(fn, records, constants.COVERAGE_GAPS_DTYPE)
 
     def filter(self, chr, base):
         """
-        Filter intervals that contain base.
+        Filter intervals that contain base, by binary search over intervals sorted by start.
 
         This was motivated by https://github.com/haessar/peaks2utr/issues/9 - the native
         pybedtools.BedTool.filter method was causing "Too many files open" errors in some
         distributed systems.
         """
-        if chr in self:
-            return [i for i in self[chr] if i.start <= base <= i.end]
-        return []
+        if chr not in self:
+            return []
+        starts, ends = self[chr]
+        idx = np.searchsorted(starts, base, side="right")
+        if self._is_disjoint(chr):
+            # At most one interval, the last to start at or before base, can contain it.
+            candidates = [idx - 1] if idx and ends[idx - 1] >= base else []
+        else:
+            candidates = np.flatnonzero(ends[:idx] >= base)
+        return [self.Interval(starts[i] - 1, ends[i]) for i in candidates]
+
+    def _is_disjoint(self, chr):
+        if chr not in self._disjoint:
+            starts, ends = self[chr]
+            self._disjoint[chr] = bool(np.all(starts[1:] > ends[:-1]))
+        return self._disjoint[chr]
+
+    def gap_edges(self, chr, bases, reverse=False):
+        """
+        Vectorised filter over array of bases. Return the lowest start of intervals containing each base, or the
+        highest end if reverse, and -1 where there are none.
+        """
+        if chr not in self or not self._is_disjoint(chr):
+            return _gap_edges(self, chr, bases, reverse)
+        bases = np.asarray(bases, dtype=np.int64)
+        starts, ends = self[chr]
+        idx = np.searchsorted(starts, bases, side="right") - 1
+        found = (idx >= 0) & (ends[np.maximum(idx, 0)] >= bases)
+        edges = np.full(len(bases), -1, dtype=np.int64)
+        edges[found] = (ends if reverse else starts)[idx[found]]
+        return edges
 
 
-class SPATTruncationPointsDict(collections.UserDict):
+class LazyZeroCoverageIntervalsDict(collections.UserDict):
     """
-    Dictionary of SPAT "truncation points" per chromosome from json file.
+    Dictionary of zero coverage intervals per (chromosome, window), found on demand from indexed BAM file.
     """
-    def __init__(self, dict=None, json_fn=None):
+    Interval = ZeroCoverageIntervalsDict.Interval
+
+    def __init__(self, dict=None, bam_fn=None, window_size=constants.COVERAGE_WINDOW_SIZE):
         super().__init__(dict)
-        if json_fn:
-            with open(json_fn, 'r') as f:
-                self.data.update(json.load(f) or {})
+        self.bam_fn = bam_fn
+        self.window_size = window_size
+        self._samfile = None
+        self._pid = None
+
+    @property
+    def samfile(self):
+        # Open BAM file once per process, so that file handles are not shared between forked workers.
+        if self._pid != os.getpid():
+            self._samfile = pysam.AlignmentFile(self.bam_fn, "rb")
+            self._pid = os.getpid()
+        return self._samfile
+
+    def _window(self, chr, idx):
+        """
+        0-based half-opened (starts, ends) of zero coverage intervals in window idx of chr, clipped to the window.
+        """
+        if (chr, idx) not in self.data:
+            start = idx * self.window_size
+            end = min(start + self.window_size, self.samfile.get_reference_length(chr))
+            self.data[(chr, idx)] = low_coverage_intervals(*aligned_blocks(self.samfile, chr, start, end), start, end)
+        return self.data[(chr, idx)]
+
+    def filter(self, chr, base):
+        """
+        Filter intervals that contain base, extending intervals clipped by window edges into neighbouring windows.
+        """
+        if not self.bam_fn or self.samfile.get_tid(chr) < 0:
+            return []
+        length = self.samfile.get_reference_length(chr)
+        first = last = (base - 1) // self.window_size
+        starts, ends = self._window(chr, first)
+        i = bisect.bisect_right(starts, base - 1) - 1
+        if i < 0 or ends[i] < base:
+            return []
+        start, end = starts[i], ends[i]
+        while start == first * self.window_size and first > 0:
+            first -= 1
+            starts, ends = self._window(chr, first)
+            if not len(ends) or ends[-1] != start:
+                break
+            start = starts[-1]
+        while end == (last + 1) * self.window_size and end < length:
+            last += 1
+            starts, ends = self._window(chr, last)
+            if not len(starts) or starts[0] != end:
+                break
+            end = ends[0]
+        return [self.Interval(start, end)]
+
+    def gap_edges(self, chr, bases, reverse=False):
+        """
+        As ZeroCoverageIntervalsDict.gap_edges.
+        """
+        return _gap_edges(self, chr, bases, reverse)
+
+
+def _gap_edges(intervals, chr, bases, reverse=False):
+    """
+    Return the lowest start of intervals containing each of bases, or the highest end if reverse, and -1 where there
+    are none, filtering intervals base by base.
+    """
+    edges = np.full(len(bases), -1, dtype=np.int64)
+    for idx, base in enumerate(np.asarray(bases).tolist()):
+        gaps = intervals.filter(chr, base)
+        if gaps:
+            edges[idx] = max(g.end for g in gaps) if reverse else min(g.start for g in gaps)
+    return edges
+
+
+class SPATTruncationPointsDict(collections.UserDict):
+    """
+    Dictionary of sorted SPAT "truncation point" positions per chromosome from binary store, memory-mapped.
+    """
+    def __init__(self, dict=None, spat_fn=None, chrs=None):
+        super().__init__()
+        for chr, points in (dict or {}).items():
+            self.data[chr] = np.array(sorted(map(int, points)), dtype=np.int64)
+        if spat_fn:
+            for chr, records in read_truncation_points(spat_fn).items():
+                if chrs is None or chr in chrs:
+                    self.data[chr] = records["pos"]
+
+    def max_in_range(self, chr, start, end):
+        """
+        Return highest truncation point on chr within start and end (inclusive), or None.
+        """
+        positions = self.data.get(chr)
+        if positions is not None:
+            idx = np.searchsorted(positions, end, side="right")
+            if idx and positions[idx - 1] >= start:
+                return int(positions[idx - 1])
+
+    def min_in_range(self, chr, start, end):
+        """
+        Return lowest truncation point on chr within start and end (inclusive), or None.
+        """
+        positions = self.data.get(chr)
+        if positions is not None:
+            idx = np.searchsorted(positions, start, side="left")
+            if idx < len(positions) and positions[idx] <= end:
+                return int(positions[idx])
+
+    def max_in_ranges(self, chr, starts, ends):
+        """
+        Vectorised max_in_range over arrays of starts and ends, with -1 where there is no truncation point.
+        """
+        points = np.full(len(starts), -1, dtype=np.int64)
+        positions = self.data.get(chr)
+        if positions is not None and len(positions):
+            idx = np.searchsorted(positions, ends, side="right") - 1
+            candidates = positions[np.maximum(idx, 0)]
+            found = (idx >= 0) & (candidates >= starts)
+            points[found] = candidates[found]
+        return points
+
+    def min_in_ranges(self, chr, starts, ends):
+        """
+        Vectorised min_in_range over arrays of starts and ends, with -1 where there is no truncation point.
+        """
+        points = np.full(len(starts), -1, dtype=np.int64)
+        positions = self.data.get(chr)
+        if positions is not None and len(positions):
+            idx = np.searchsorted(positions, starts, side="left")
+            candidates = positions[np.minimum(idx, len(positions) - 1)]
+            found = (idx < len(positions)) & (candidates <= ends)
+            points[found] = candidates[found]
+        return points
 
 
 class BroadPeaksList(collections.UserList):
@@ -160,3 +631,138 @@ class BroadPeaksList(collections.UserList):
                 self.data = [Peak(*peak) for peak in csv.reader(f, delimiter="\t")]
                 for peak in self.data:
                     peak.strand = constants.STRAND_MAP.get(strand)
+
+
+class AnnotationIndex:
+    """
+    In-memory index of genes, their transcripts and the UTRs of those transcripts, loaded once from a gffutils db so
+    that annotating a peak makes no sqlite queries. Duck-types the FeatureDB.region and FeatureDB.children calls made by
+    AnnotationsPipeline and criteria, returning copies of indexed features as these get their coordinates modified.
+    Queries beyond what is indexed fall back to the db. Pass optional chrs to index only genes on those chromosomes.
+    """
+    gene_featuretypes = constants.FeatureTypes.Gene + constants.FeatureTypes.NonCodingGene
+    child_featuretypes = constants.FeatureTypes.GffTranscript + constants.FeatureTypes.GtfTranscript + \
+        constants.FeatureTypes.ThreePrimeUTR + constants.FeatureTypes.FivePrimeUTR
+
+    def __init__(self, db, chrs=None):
+        self.db = db
+        # {seqid: {strand: (genes sorted by start, starts, running max of ends)}}
+        self.genes = {}
+        # {parent id: indexed child features, in the order of the relations table}
+        self.children_map = collections.defaultdict(list)
+        self.chrs = set()
+        if chrs is None:
+            self._load()
+        else:
+            self.load(chrs)
+
+    def load(self, chrs):
+        """
+        Index genes on any of chrs not indexed yet.
+        """
+        for chr in sorted(set(chrs) - self.chrs):
+            self._load(chr)
+
+    def _load(self, chr=None):
+        """
+        Index genes on chr, or all chromosomes.
+        """
+        chr_clause = " AND features.seqid = ?" if chr is not None else ""
+        chr_args = [chr] if chr is not None else []
+        genes = collections.defaultdict(lambda: collections.defaultdict(list))
+        for row in self.db.conn.execute(
+                "%s WHERE featuretype IN (%s)%s" % (
+                    gffutils.constants._SELECT, ", ".join("?" * len(self.gene_featuretypes)), chr_clause),
+                self.gene_featuretypes + chr_args):
+            gene = self.db._feature_returner(**row)
+            genes[gene.seqid][gene.strand].append(gene)
+        for seqid, strands in genes.items():
+            self.genes[seqid] = {}
+            for strand, features in strands.items():
+                features.sort(key=lambda x: (x.start, x.file_order))
+                self.genes[seqid][strand] = (
+                    features,
+                    [f.start for f in features],
+                    list(itertools.accumulate((f.end for f in features), max)),
+                )
+        for row in self.db.conn.execute(
+                "SELECT DISTINCT relations.parent AS parent, %s, features.rowid AS file_order FROM relations "
+                "JOIN features ON relations.child = features.id WHERE features.featuretype IN (%s)%s "
+                "ORDER BY relations.parent, relations.child" % (
+                    ", ".join("features." + k for k in gffutils.constants._keys),
+                    ", ".join("?" * len(self.child_featuretypes)), chr_clause),
+                self.child_featuretypes + chr_args):
+            row = dict(row)
+            self.children_map[row.pop("parent")].append(self.db._feature_returner(**row))
+        if chr is None:
+            self.chrs.update(self.genes)
+        else:
+            self.chrs.add(chr)
+
+    @staticmethod
+    def in_region(feature, start, end):
+        """
+        Whether feature overlaps start-end, as queried by FeatureDB.region.
+        """
+        if start and end:
+            return feature.start <= end and feature.end >= start
+        # Mirror gffutils, which drops falsy (zero) bounds and compares the remaining one strictly.
+        return (not end or feature.start < end) and (not start or feature.end > start)
+
+    def iter_genes(self, seqid, strand=None, start=None):
+        """
+        Iterate over indexed genes on seqid, and strand if given, in order of start. Genes are not copied. Pass optional
+        start to skip genes ending before it.
+        """
+        return heapq.merge(*[itertools.islice(genes, bisect.bisect_left(max_ends, start) if start else 0, None)
+                             for gene_strand, (genes, _, max_ends) in self.genes.get(seqid, {}).items()
+                             if strand is None or gene_strand == strand],
+                           key=lambda x: (x.start, x.file_order))
+
+    @staticmethod
+    def _featuretypes(featuretype):
+        return [featuretype] if isinstance(featuretype, str) else featuretype
+
+    def region(self, region=None, seqid=None, start=None, end=None, strand=None, featuretype=None,
+               completely_within=False):
+        """
+        As FeatureDB.region for indexed genes overlapping seqid:start-end.
+        """
+        featuretypes = self._featuretypes(featuretype)
+        if region is not None or completely_within or None in (seqid, start, end, featuretypes) or \
+                not set(featuretypes).issubset(self.gene_featuretypes):
+            yield from self.db.region(region=region, seqid=seqid, start=start, end=end, strand=strand,
+                                      featuretype=featuretype, completely_within=completely_within)
+            return
+        features = []
+        for gene_strand, (genes, starts, max_ends) in self.genes.get(seqid, {}).items():
+            if strand is not None and gene_strand != strand:
+                continue
+            if start and end:
+                candidates = genes[bisect.bisect_left(max_ends, start):bisect.bisect_right(starts, end)]
+                features.extend(f for f in candidates if f.end >= start)
+            else:
+                features.extend(f for f in genes if self.in_region(f, start, end))
+        features.sort(key=lambda x: (x.start, x.file_order))
+        for f in features:
+            if f.featuretype in featuretypes:
+                yield copy.copy(f)
+
+    def children(self, id, level=None, featuretype=None, order_by=None, reverse=False, limit=None,
+                 completely_within=False):
+        """
+        As FeatureDB.children for indexed children of given featuretype.
+        """
+        featuretypes = self._featuretypes(featuretype)
+        if level is not None or limit is not None or completely_within or featuretypes is None or \
+                order_by not in (None, "start", "end") or not set(featuretypes).issubset(self.child_featuretypes):
+            yield from self.db.children(id, level=level, featuretype=featuretype, order_by=order_by, reverse=reverse,
+                                        limit=limit, completely_within=completely_within)
+            return
+        if isinstance(id, gffutils.Feature):
+            id = id.id
+        features = [f for f in self.children_map.get(id, []) if f.featuretype in featuretypes]
+        if order_by:
+            features.sort(key=lambda x: getattr(x, order_by), reverse=reverse)
+        for f in features:
+            yield copy.copy(f)
@@ -34,9 +34,11 @@ STRAND_CIGAR_SOFT_CLIP_REGEX = {
     "reverse": r"^([0-9]+)S"
 }
 
-STRAND_PYSAM_ARGS = {
-    'forward': ["-F", "20"],
-    'reverse': ["-f", "16"],
+# SAM flag masks for demultiplexing strands: forward reads must have none of the 'forward' bits set (i.e. neither
+# reverse-complemented nor unmapped), reverse reads must have all of the 'reverse' bits set.
+STRAND_SAM_FLAGS = {
+    'forward': 20,
+    'reverse': 16,
 }
 
 GFFUTILS_GTF_DIALECT = {
@@ -63,9 +65,35 @@ GFFUTILS_GFF_DIALECT = {
     'order': ['ID', 'Parent', 'colour']
 }
 
+# Record of a SPAT truncation point (1-based position) and the number of reads piled up on it.
+SPAT_DTYPE = [('pos', '<i8'), ('count', '<i8')]
+
+# Record of zero coverage interval in binary store, 1-based included.
+COVERAGE_GAPS_DTYPE = [('start', '<i8'), ('end', '<i8')]
+
+# Size in bases of the windows that zero coverage intervals are found in with --lazy-coverage-gaps.
+COVERAGE_WINDOW_SIZE = 10000
+
+# Size in bases of the windows that read coverage of a chromosome is counted in, bounding its per-base depth array.
+COVERAGE_DEPTH_WINDOW_SIZE = 1 << 20
+
+# Number of genes whose features are held in memory in front of the on-disk store with --low-memory.
+FEATURE_STORE_CACHE_SIZE = 10000
+
+# Number of peaks an annotation worker first claims at a time, and the bounds it adapts this between so that each chunk
+# of peaks takes around PEAK_CHUNK_SECONDS.
+PEAK_CHUNK_SIZE = 16
+MIN_PEAK_CHUNK_SIZE = 1
+MAX_PEAK_CHUNK_SIZE = 4096
+PEAK_CHUNK_SECONDS = 0.2
+
+# Seconds that results of annotation workers are waited for at a time, between checks for exited workers.
+RESULTS_POLL_SECONDS = 0.1
+
 CACHE_DIR = os.path.join(os.getcwd(), '.cache')
 LOG_DIR = os.path.join(os.getcwd(), '.log')
 
-TMP_GFF_FN = "_tmp.gff"
-
 PERC_ALLOCATED_VRAM = 75
+
+# Number of times a failed worker task is re-run before aborting.
+TASK_RETRIES = 1
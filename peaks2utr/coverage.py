@@ -0,0 +1,96 @@
+"""
+Native replacement for `bedtools genomecov -bga -split` followed by filtering and merging of low-coverage intervals.
+All coordinates are 0-based half-opened, as in BED.
+"""
+import numpy as np
+import pysam
+
+from . import constants
+
+
+def aligned_blocks(samfile, chr, start, end):
+    """
+    Return (starts, ends) arrays of the aligned blocks of mapped reads overlapping region chr:start-end, clipped to
+    the region. As with `bedtools genomecov -split`, reads are split into blocks at skipped regions (N) only: deletions
+    count as covered, whereas insertions and clipped bases do not.
+    """
+    starts, ends = [], []
+    for seg in samfile.fetch(chr, start, end):
+        if seg.is_unmapped:
+            continue
+        cigar = seg.cigartuples
+        if len(cigar) == 1:
+            starts.append(seg.reference_start)
+            ends.append(seg.reference_end)
+            continue
+        pos = block_start = seg.reference_start
+        for op, length in cigar:
+            if op == pysam.CREF_SKIP:
+                if pos > block_start:
+                    starts.append(block_start)
+                    ends.append(pos)
+                pos += length
+                block_start = pos
+            elif op in (pysam.CMATCH, pysam.CEQUAL, pysam.CDIFF, pysam.CDEL):
+                pos += length
+        if pos > block_start:
+            starts.append(block_start)
+            ends.append(pos)
+    starts = np.clip(np.array(starts, dtype=np.int64), start, end)
+    ends = np.clip(np.array(ends, dtype=np.int64), start, end)
+    return starts, ends
+
+
+def low_coverage_intervals(block_starts, block_ends, start, end, min_cov=1):
+    """
+    Return (starts, ends) arrays of the maximal intervals within region start-end covered by fewer than min_cov of
+    the given blocks, which must be clipped to the region. Depth is counted per base of the region, so memory is
+    bounded by its length rather than by the number of blocks.
+    """
+    if end <= start:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    diff = np.zeros(end - start + 1, dtype=np.int32)
+    np.add.at(diff, np.asarray(block_starts, dtype=np.int64) - start, 1)
+    np.add.at(diff, np.asarray(block_ends, dtype=np.int64) - start, -1)
+    low = np.zeros(end - start + 2, dtype=np.int8)
+    low[1:-1] = np.cumsum(diff[:-1], dtype=np.int32) < min_cov
+    # Runs of low coverage start where low switches on and end where it switches off.
+    edges = np.flatnonzero(np.diff(low)) + start
+    return edges[0::2], edges[1::2]
+
+
+def merge_book_ended(starts, ends):
+    """
+    Merge book-ended intervals of sorted (starts, ends) arrays.
+    """
+    merged_starts = np.ones(len(starts), dtype=bool)
+    merged_starts[1:] = starts[1:] != ends[:-1]
+    merged_ends = np.ones(len(ends), dtype=bool)
+    merged_ends[:-1] = merged_starts[1:]
+    return starts[merged_starts], ends[merged_ends]
+
+
+def zero_coverage_intervals(bam_fn, chr, start, end, min_cov=1, window_size=constants.COVERAGE_DEPTH_WINDOW_SIZE):
+    """
+    Return (starts, ends) arrays of the maximal intervals within region chr:start-end of indexed bam_fn with read
+    coverage lower than min_cov. Coverage is found one window of window_size bases at a time.
+    """
+    starts, ends = [], []
+    with pysam.AlignmentFile(bam_fn, "rb") as samfile:
+        for window_start in range(start, end, window_size):
+            window_end = min(window_start + window_size, end)
+            window_starts, window_ends = low_coverage_intervals(
+                *aligned_blocks(samfile, chr, window_start, window_end), window_start, window_end, min_cov)
+            starts.append(window_starts)
+            ends.append(window_ends)
+    if not starts:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    # Intervals clipped by window edges are book-ended with those of the next window.
+    return merge_book_ended(np.concatenate(starts), np.concatenate(ends))
+
+
+def write_bed(f, chr, starts, ends):
+    """
+    Write intervals of chr to open BED file f.
+    """
+    f.writelines("%s\t%d\t%d\n" % (chr, s, e) for s, e in zip(np.asarray(starts).tolist(), np.asarray(ends).tolist()))
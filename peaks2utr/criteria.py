@@ -1,8 +1,17 @@
 import logging
 
+import numpy as np
+
 from .constants import FeatureTypes
 from .utils import Counter
 
+# Codes of the first criterion failed by a peak and transcript pair, as evaluated by evaluate_batch.
+PASSED = 0
+UTR_ALREADY_ANNOTATED = 1
+PEAK_SUBSET_OF_TRANSCRIPT = 2
+NOT_3_PRIME_END = 3
+TRANSCRIPT_SUBSET_OF_ADJACENT_GENE = 4
+
 
 class CriteriaFailure(Exception):
     pass
@@ -50,7 +59,7 @@ def assert_peak_not_a_subset_of_transcript(peak, transcript):
     If a peak occurs entirely within an existing transcript annotation (i.e. it's a subset), we consider that it is already
     accounted for and can't possibly refer to a new UTR.
     """
-    if peak.range.issubset(transcript.range):
+    if peak.interval.issubset(transcript.interval):
         raise CriteriaFailure("%s %s wholly contained within transcript %s"
                               % (peak.__class__.__name__, peak.name, transcript.id))
 
@@ -59,7 +68,7 @@ def assert_transcript_not_a_subset_of_adjacent_gene(transcript, adj_transcript,
     """
     If a transcript occurs entirely within another gene's transcript, its 3' UTR should not be annotated.
     """
-    if transcript.range.issubset(adj_transcript.range):
+    if transcript.interval.issubset(adj_transcript.interval):
         raise CriteriaFailure("%s %s wholly contained within transcript %s of gene %s"
                               % (transcript.__class__.__name__, transcript.id, adj_transcript.id, gene.id))
 
@@ -85,9 +94,52 @@ def truncate_to_adjacent_transcript(peak, transcript, utr, adj_transcript, gene,
     If a peak is broad enough that it overlaps a transcript of another gene, we check for an
     intersection and truncate if it exists (taking into account assumed 5' extension).
     """
-    if utr.range.intersection(adj_transcript.range):
+    if utr.interval.overlaps(adj_transcript.interval):
         logging.debug("Peak %s overlapping transcript %s of gene %s: Truncating" % (peak.name, adj_transcript.id, gene.id))
         if peak.strand == "+" and adj_transcript.start > transcript.end:
             utr.end = adj_transcript.start - 1 - five_prime_ext
         elif peak.strand == "-" and adj_transcript.end < transcript.start:
             utr.start = adj_transcript.end + 1 + five_prime_ext
+
+
+def evaluate_batch(strand, peak_starts, peak_ends, transcript_starts, transcript_ends, utr_starts, utr_ends,
+                   override_utr, extend_utr):
+    """
+    Evaluate assert_whether_utr_already_annotated, assert_peak_not_a_subset_of_transcript and
+    assert_3_prime_end_and_truncate at once over arrays of peaks and transcripts on strand, without raising
+    CriteriaFailure. The existing 3' UTRs of each transcript are given by their lowest start and highest end, or -1 if
+    there are none.
+
+    Return arrays of the code of the first criterion failed by each pair, of transcript starts and ends modified to
+    account for existing 3' UTRs, and of new UTR starts and ends.
+    """
+    peak_starts, peak_ends, transcript_starts, transcript_ends, utr_starts, utr_ends = (
+        np.asarray(a, dtype=np.int64)
+        for a in (peak_starts, peak_ends, transcript_starts, transcript_ends, utr_starts, utr_ends))
+    codes = np.full(len(peak_starts), PASSED, dtype=np.int8)
+    existing = utr_starts >= 0
+    if override_utr or extend_utr:
+        if strand == "+":
+            transcript_ends = np.where(existing, utr_starts - 1 if override_utr else utr_ends, transcript_ends)
+        else:
+            transcript_starts = np.where(existing, utr_ends + 1 if override_utr else utr_starts, transcript_starts)
+    else:
+        codes[existing] = UTR_ALREADY_ANNOTATED
+    subset = (peak_starts >= transcript_starts) & (peak_ends <= transcript_ends)
+    codes[(codes == PASSED) & subset] = PEAK_SUBSET_OF_TRANSCRIPT
+    if strand == "+":
+        three_prime = peak_ends > transcript_ends
+        new_starts, new_ends = np.where(three_prime, transcript_ends + 1, peak_starts), peak_ends
+    else:
+        three_prime = peak_starts < transcript_starts
+        new_starts, new_ends = peak_starts, np.where(three_prime, transcript_starts - 1, peak_ends)
+    codes[(codes == PASSED) & ~three_prime] = NOT_3_PRIME_END
+    return codes, transcript_starts, transcript_ends, new_starts, new_ends
+
+
+# Criteria tracking failed peaks, by code as evaluated by evaluate_batch.
+BATCH_CRITERIA = {
+    UTR_ALREADY_ANNOTATED: assert_whether_utr_already_annotated,
+    PEAK_SUBSET_OF_TRANSCRIPT: assert_peak_not_a_subset_of_transcript,
+    NOT_3_PRIME_END: assert_3_prime_end_and_truncate,
+}
@@ -2,7 +2,7 @@ class AnnotationsError(Exception):
     pass
 
 
-class PybedtoolsError(Exception):
+class CoverageError(Exception):
     pass
 
 
@@ -15,7 +15,7 @@ class MACSError(Exception):
 
 
 EXCEPTIONS_MAP = {
-    "_find_zero_coverage_intervals": PybedtoolsError,
+    "_find_zero_coverage_intervals": CoverageError,
     "_count_unmapped_pileups": PysamError,
     "call_peaks": MACSError,
     "valid_bam": PysamError,
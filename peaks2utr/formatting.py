@@ -0,0 +1,99 @@
+"""
+Serialization of gffutils Features to GFF3 / GTF lines, identical to str(feature) but with the attribute format of
+each dialect compiled once rather than interpreted for every feature.
+"""
+import copy
+
+import gffutils
+
+# Characters percent-encoded in GFF3 attribute values by gffutils.
+GFF3_ESCAPES = str.maketrans({c: "%{:02X}".format(ord(c)) for c in gffutils.parser._to_quote})
+
+
+class AttributesFormat:
+    """
+    Attributes column format of a gffutils dialect, as by gffutils.parser._reconstruct.
+    """
+    def __init__(self, dialect):
+        self.dialect = dialect
+        self.gff3 = dialect["fmt"] == "gff3"
+        self.gtf = dialect["fmt"] == "gtf"
+        self.repeated_keys = dialect["repeated keys"]
+        self.order = {key: idx for idx, key in reversed(list(enumerate(dialect["order"])))}
+        self.multival_sep = dialect["multival separator"]
+        self.field_sep = dialect["field separator"]
+        self.keyval_sep = dialect["keyval separator"]
+        self.keyval_template = self.keyval_sep.join(
+            ["%s", '"%s"' if dialect["quoted GFF2 values"] else "%s"])
+        self.trailing = ";" if dialect["trailing semicolon"] else ""
+
+    def format(self, attributes, keep_order=False, sort_attribute_values=False):
+        if not attributes:
+            return ""
+        escape = self.gff3 and not gffutils.constants.ignore_url_escape_characters
+        if isinstance(attributes, gffutils.attributes.Attributes) and gffutils.constants.always_return_list:
+            # Skip the per-item lookups of Attributes.items, which returns the same lists.
+            items = list(attributes._d.items())
+        else:
+            items = list(attributes.items())
+        if self.repeated_keys:
+            items = [item for key, val in items for item in ([(key, [v]) for v in val] if len(val) > 1
+                                                             else [(key, val)])]
+        if keep_order:
+            items.sort(key=self._order_key)
+        parts = []
+        for key, val in items:
+            if val:
+                if escape:
+                    val = [v.translate(GFF3_ESCAPES) for v in val]
+                if sort_attribute_values:
+                    val = sorted(val)
+                val_str = self.multival_sep.join(val)
+                parts.append(self.keyval_template % (key, val_str) if val_str else key)
+            elif self.gtf:
+                parts.append(self.keyval_sep.join([key, '""']))
+            else:
+                parts.append(key)
+        return self.field_sep.join(parts) + self.trailing
+
+    def _order_key(self, item):
+        # Keys in order of dialect, then any others
+        return self.order.get(item[0], 1e6)
+
+
+class FeatureSerializer:
+    """
+    Callable returning line of feature, optionally as another featuretype, identical to str(feature) + newline. Falls
+    back to str(feature) for anything that can't be formatted directly.
+    """
+    def __init__(self):
+        self._formats = {}
+
+    def _attributes_format(self, dialect):
+        attributes_format = self._formats.get(id(dialect))
+        # Hold on to dialect so that its id can't be reused while cached.
+        if attributes_format is None or attributes_format.dialect is not dialect:
+            attributes_format = self._formats[id(dialect)] = AttributesFormat(dialect)
+        return attributes_format
+
+    def __call__(self, feature, featuretype=None):
+        try:
+            line = "\t".join([
+                feature.seqid,
+                feature.source,
+                featuretype or feature.featuretype,
+                "." if feature.start is None else str(feature.start),
+                "." if feature.end is None else str(feature.end),
+                feature.score,
+                feature.strand,
+                feature.frame,
+                self._attributes_format(feature.dialect).format(
+                    feature.attributes, feature.keep_order, feature.sort_attribute_values),
+                *feature.extra,
+            ])
+        except (AttributeError, KeyError, TypeError):
+            if featuretype:
+                feature = copy.copy(feature)
+                feature.featuretype = featuretype
+            line = str(feature)
+        return line + "\n"
@@ -2,6 +2,7 @@
 For a discussion of 0-based/1-based counting systems,
 see https://genome-blog.soe.ucsc.edu/blog/2016/12/12/the-ucsc-genome-browser-coordinate-counting-systems/
 """
+from collections import namedtuple
 import re
 
 import gffutils
@@ -9,6 +10,47 @@ import gffutils
 from .constants import AnnotationColour, FeatureTypes, STRAND_CIGAR_SOFT_CLIP_REGEX, GFFUTILS_GFF_DIALECT, GFFUTILS_GTF_DIALECT
 
 
+class Interval:
+    """
+    Interval of bases, 1-based included. Empty if end is lower than start.
+    Supports the set operations of RangeMixin.range in constant time.
+    """
+    __slots__ = ("start", "end")
+
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        return "<%s: (%s, %s)>" % (self.__class__.__name__, self.start, self.end)
+
+    def __bool__(self):
+        return self.end >= self.start
+
+    def __len__(self):
+        return max(0, self.end - self.start + 1)
+
+    def __contains__(self, base):
+        return self.start <= base <= self.end
+
+    def __eq__(self, other):
+        if not self or not other:
+            return not self and not other
+        return self.start == other.start and self.end == other.end
+
+    def __hash__(self):
+        return hash((self.start, self.end)) if self else hash(None)
+
+    def issubset(self, other):
+        return not self or (bool(other) and other.start <= self.start and self.end <= other.end)
+
+    def intersection(self, other):
+        return Interval(max(self.start, other.start), min(self.end, other.end))
+
+    def overlaps(self, other):
+        return bool(self.intersection(other))
+
+
 class RangeMixin:
     """
     Like gff/gtf this class mixin is 1-based included
@@ -16,8 +58,15 @@ class RangeMixin:
     start: int
     end: int
 
+    @property
+    def interval(self):
+        return Interval(self.start, self.end)
+
     @property
     def range(self):
+        """
+        Set of all bases. Prefer interval, which doesn't materialise them.
+        """
         return set(range(self.start, self.end + 1))
 
     @property
@@ -80,7 +129,7 @@ class UTR(RangeMixin):
         return "<%s: (%s, %s)>" % (self.__class__.__name__, self.start, self.end)
 
     def __eq__(self, other):
-        return self.range == other.range
+        return self.interval == other.interval
 
     def _create_id(self, transcript, db):
         existing_utrs = list(db.children(transcript, featuretype=FeatureTypes.ThreePrimeUTR)) + \
@@ -125,6 +174,31 @@ class UTR(RangeMixin):
         return self.end >= self.start
 
 
+class AnnotatedUTR(namedtuple("AnnotatedUTR", ["gene_id", "transcript_id", "start", "end", "colour"]), RangeMixin):
+    """
+    New 3' UTR of a gene's transcript, as passed back from annotation workers in place of the gene's features. These
+    are generated only once per gene, when merging annotations.
+    """
+    __slots__ = ()
+
+
+class BAMRegion(namedtuple("BAMRegion", ["bam", "chr", "start", "end"], defaults=(None, None, None))):
+    """
+    Region of a BAM file, 0-based half-opened. A region without chr spans the whole file.
+    """
+    def fetch(self, samfile):
+        """
+        Iterate over reads in samfile that start within region, so that reads spanning adjacent regions are only
+        visited once. Requires an indexed samfile unless region spans the whole file.
+        """
+        if self.chr is None:
+            yield from samfile.fetch(until_eof=True)
+        else:
+            for seg in samfile.fetch(self.chr, self.start, self.end):
+                if seg.reference_start >= self.start:
+                    yield seg
+
+
 class SoftClippedRead:
     """
     Read in SAM file format and store in 1-based included
@@ -1,18 +1,28 @@
+import collections
 import logging
-import os.path
-import shutil
-import subprocess
-
+import re
 import sqlite3
+from urllib.parse import unquote
 
 from . import criteria
-from .constants import FeatureTypes, LOG_DIR, TMP_GFF_FN
+from .constants import FeatureTypes
 from .models import FeatureDB
-from .utils import cached, features_dict_for_gene, format_stats_line
+from .utils import children_of_genes, features_dict_for_gene, features_dict_for_utr, format_stats_line
 
 
-def write_summary_stats(annotations, pipeline):
+def write_summary_stats(annotations, pipeline, feature_counts=None):
+    """
+    Write summary statistics file. 3' UTRs are counted from the features of annotations, or from feature_counts of
+    (featuretype, source) when given, as returned by write_pass_through_annotations.
+    """
     total_peaks = pipeline.total_peaks
+    if feature_counts is None:
+        total_utrs = annotations.count(featuretype=FeatureTypes.ThreePrimeUTR)
+        new_utrs = annotations.count(featuretype=FeatureTypes.ThreePrimeUTR, source=__package__)
+    else:
+        total_utrs = sum(count for (featuretype, _), count in feature_counts.items()
+                         if featuretype in FeatureTypes.ThreePrimeUTR)
+        new_utrs = sum(feature_counts[(featuretype, __package__)] for featuretype in FeatureTypes.ThreePrimeUTR)
     with open('summary_stats.txt', 'w') as fstats:
         logging.info("Writing summary statistics file.")
         fstats.write(format_stats_line("Total peaks", total_peaks))
@@ -25,54 +35,188 @@ def write_summary_stats(annotations, pipeline):
                                        int(criteria.assert_3_prime_end_and_truncate.fails)))
         fstats.write(format_stats_line("\t...corresponding to potential 3' UTR removed due to zero read coverage",
                                        total_peaks, int(pipeline.zero_coverage_removal_counter)))
-        fstats.write(format_stats_line("Total 3' UTRs", len(annotations.filter(featuretype=FeatureTypes.ThreePrimeUTR))))
-        fstats.write(format_stats_line("\t...annotated by {}".format(__package__),
-                                       len(annotations.filter(featuretype=FeatureTypes.ThreePrimeUTR, source=__package__))))
+        fstats.write(format_stats_line("Total 3' UTRs", total_utrs))
+        fstats.write(format_stats_line("\t...annotated by {}".format(__package__), new_utrs))
 
 
-def merge_annotations(db, annotations):
+def merge_annotations(db, annotations, include_untouched=True):
     """
-    Update three_prime_UTR annotations dict with all features from GFF_IN file.
+    Update three_prime_UTR annotations dict with all features from GFF_IN file, generating features of genes with a
+    new 3' UTR from their AnnotatedUTR record. Children of all genes are streamed from a single ordered query. Without
+    include_untouched, only genes with a new 3' UTR are merged, as for write_pass_through_annotations.
     """
     logging.info("Merging annotations with canonical gff file.")
 
     db = sqlite3.connect(db, check_same_thread=False)
     db = FeatureDB(db)
-    for gene in db.all_features(featuretype=FeatureTypes.Gene + FeatureTypes.NonCodingGene):
-        if gene.id not in annotations:
-            features = features_dict_for_gene(db, gene)
-            annotations[gene.id] = features
-
-
-def gt_gff3_sort(annotations, new_gff_fn, force=False, gtf_out=False):
-    """
-    Use genometools (gt) binary to sort and tidy tmp file into new combined output gff3 file.
-    """
-    log_fn = "gt_gff3.log"
-    with open(cached(TMP_GFF_FN), 'w') as fout:
-        fout.writelines(annotations.iter_feature_strings())
-    if not gtf_out:
-        command = "gt gff3 -sort -retainids -tidy -o {} ".format(new_gff_fn)
-        if force:
-            command += "-force "
-        with open(os.path.join(LOG_DIR, log_fn), 'w') as flog:
-            try:
-                output = subprocess.check_output(
-                    command + cached(TMP_GFF_FN),
-                    universal_newlines=True,
-                    stderr=subprocess.STDOUT,
-                    shell=True
-                )
-            except subprocess.CalledProcessError as e:
-                flog.write(e.output)
-                if e.returncode == 127:
-                    logging.warning("Genometools binary can't be called. Please ensure it is installed.")
-            except MemoryError:
-                logging.warning("Process required too much memory. Aborting.")
-            else:
-                flog.write(output)
-                if os.path.exists(new_gff_fn):
-                    logging.info("Successfully formatted GFF3 output file %s using genometools." % new_gff_fn)
-                    return
-        logging.warning("Some issues were encountered when processing output file. Check %s." % log_fn)
-    shutil.copy(cached(TMP_GFF_FN), new_gff_fn)
+    featuretypes = FeatureTypes.Gene + FeatureTypes.NonCodingGene
+    if not include_untouched:
+        for gene_id in list(annotations.utrs):
+            gene = db[gene_id]
+            if gene.featuretype in featuretypes:
+                annotations[gene_id] = features_dict_for_utr(db, gene, annotations.utrs.pop(gene_id), annotations.gtf_in)
+        return
+    # Genes and groups of their children are both in file order of genes, so are walked together.
+    groups = children_of_genes(db, featuretypes)
+    parent, children = next(groups, (None, []))
+    for gene in db.all_features(featuretype=featuretypes, order_by="rowid"):
+        gene_children = []
+        if parent == gene.id:
+            gene_children = children
+            parent, children = next(groups, (None, []))
+        if gene.id in annotations.utrs:
+            annotations[gene.id] = features_dict_for_utr(db, gene, annotations.utrs.pop(gene.id), annotations.gtf_in,
+                                                         gene_children)
+        elif gene.id not in annotations:
+            annotations[gene.id] = features_dict_for_gene(db, gene, children=gene_children)
+
+
+def write_sorted_annotations(annotations, new_gff_fn):
+    """
+    Write annotations to new combined output file. GFF3 output is sorted and in hierarchy order as by
+    `gt gff3 -sort -retainids`, whereas GTF output is written in order of annotations.
+    """
+    logging.info("Writing sorted output file %s." % new_gff_fn)
+    with open(new_gff_fn, 'w', buffering=1 << 20) as fout:
+        fout.writelines(annotations.iter_sorted_feature_strings())
+
+
+def write_pass_through_annotations(annotations, gff_in, new_gff_fn):
+    """
+    Write GFF_IN to new output file with lines of untouched features copied verbatim. Only the coordinates of genes and
+    transcripts extended to a new 3' UTR are rewritten, and the new 3' UTR features (and matching exons for GTF) are
+    inserted after the last line of their transcript. GFF_IN is read twice, once to find the last lines of transcripts
+    and once to write. Output must be in the same format as GFF_IN.
+    Return collections.Counter of (featuretype, source) of features written.
+    """
+    logging.info("Writing pass-through output file %s." % new_gff_fn)
+    gtf = annotations.gtf_in
+    rewrites = {}
+    new_lines = {}
+    for gene_id, features in annotations.items():
+        if "utr" not in features:
+            continue
+        gene, transcript = features["gene"], features["transcript"]
+        for f in [gene, transcript]:
+            rewrites[(f.seqid, f.featuretype, _node_id(f, gtf))] = (f.start, f.end)
+        utr_lines = [annotations.serializer(f, featuretype)
+                     for f, featuretype in annotations._iter_formatted_features(gene_id, {"utr": features["utr"]})]
+        new_lines[(transcript.seqid, _transcript_id(transcript, gtf))] = utr_lines
+    rewrite_types = {featuretype for _, featuretype, _ in rewrites}
+
+    last_lines = {}
+    with _open_verbatim(gff_in) as fin:
+        for line_no, fields in _iter_feature_fields(fin):
+            for transcript_id in _line_transcript_ids(fields, gtf):
+                if (fields[0], transcript_id) in new_lines:
+                    last_lines[(fields[0], transcript_id)] = line_no
+    insertions = collections.defaultdict(list)
+    for key, utr_lines in new_lines.items():
+        if key not in last_lines:
+            logging.warning("Transcript %s not found in %s. Appending its 3' UTR to end of output." % (key[1], gff_in))
+        insertions[last_lines.get(key)].extend(utr_lines)
+
+    feature_counts = collections.Counter()
+    with _open_verbatim(gff_in) as fin, _open_verbatim(new_gff_fn, 'w', buffering=1 << 20) as fout:
+        for line_no, line, fields in _iter_feature_fields(fin, yield_lines=True):
+            if fields:
+                if fields[2] in rewrite_types:
+                    coords = rewrites.get((fields[0], fields[2], _line_node_id(fields, gtf)))
+                    if coords:
+                        fields[3], fields[4] = str(coords[0]), str(coords[1])
+                        line = "\t".join(fields)
+                feature_counts[(fields[2], fields[1])] += 1
+            fout.write(line)
+            if line_no in insertions:
+                if not line.endswith("\n"):
+                    fout.write("\n")
+                # Inserted lines end as the line before them.
+                if line.endswith("\r\n"):
+                    fout.writelines(utr_line[:-1] + "\r\n" for utr_line in insertions[line_no])
+                else:
+                    fout.writelines(insertions[line_no])
+        fout.writelines(insertions[None])
+    for utr_lines in new_lines.values():
+        for line in utr_lines:
+            fields = line.split("\t", 3)
+            feature_counts[(fields[2], fields[1])] += 1
+    return feature_counts
+
+
+# Values of the attributes identifying features, searched for in attribute columns of GFF3 or GTF lines without
+# parsing the rest of them.
+_ATTRIBUTE_PATTERNS = {
+    False: {key: re.compile(r"(?:^|;)\s*%s=([^;\t\r\n]*)" % key) for key in ["ID", "Parent"]},
+    True: {key: re.compile(r'(?:^|;)\s*%s\s+"?([^";\t\r\n]*)' % key) for key in ["gene_id", "transcript_id"]},
+}
+
+
+def _open_verbatim(fn, mode='r', **kwargs):
+    """
+    Open text file without translating line endings, and with bytes that aren't UTF-8 passed through as surrogates,
+    so that lines are written back exactly as read.
+    """
+    return open(fn, mode, newline='', encoding="utf-8", errors="surrogateescape", **kwargs)
+
+
+def _attribute_values(attributes, key, gtf):
+    match = _ATTRIBUTE_PATTERNS[gtf][key].search(attributes)
+    if not match:
+        return []
+    if gtf:
+        return [match.group(1).strip()]
+    return [unquote(value) for value in match.group(1).split(",")]
+
+
+def _node_id(feature, gtf):
+    """
+    Identifier of gene or transcript feature, as found in its line of GFF_IN.
+    """
+    if gtf:
+        key = "gene_id" if feature.featuretype in FeatureTypes.Gene + FeatureTypes.NonCodingGene else "transcript_id"
+    else:
+        key = "ID"
+    return feature.attributes.get(key, [feature.id])[0]
+
+
+def _transcript_id(transcript, gtf):
+    return transcript.attributes.get("transcript_id" if gtf else "ID", [transcript.id])[0]
+
+
+def _line_node_id(fields, gtf):
+    if gtf:
+        key = "gene_id" if fields[2] in FeatureTypes.Gene + FeatureTypes.NonCodingGene else "transcript_id"
+    else:
+        key = "ID"
+    values = _attribute_values(fields[8], key, gtf)
+    return values[0] if values else None
+
+
+def _line_transcript_ids(fields, gtf):
+    """
+    Identifiers of transcripts that line is, or is a child of.
+    """
+    if gtf:
+        return _attribute_values(fields[8], "transcript_id", gtf)
+    return _attribute_values(fields[8], "ID", gtf) + _attribute_values(fields[8], "Parent", gtf)
+
+
+def _iter_feature_fields(fin, yield_lines=False):
+    """
+    Yield (line number, fields) of feature lines of GFF / GTF file, or (line number, line, fields or None) of all lines
+    with yield_lines. Lines after a ##FASTA directive are not features.
+    """
+    fasta = False
+    for line_no, line in enumerate(fin):
+        fields = None
+        if not fasta:
+            if line.startswith("##FASTA"):
+                fasta = True
+            elif not line.startswith("#"):
+                fields = line.split("\t")
+                if len(fields) < 9:
+                    fields = None
+        if yield_lines:
+            yield line_no, line, fields
+        elif fields:
+            yield line_no, fields
@@ -1,7 +1,6 @@
 import asyncio
 from collections import defaultdict
 from glob import glob
-import json
 import logging
 import os.path
 import re
@@ -11,47 +10,78 @@ import gffutils
 import pysam
 from tqdm import tqdm
 
+from .coverage import write_bed, zero_coverage_intervals
 from .exceptions import EXCEPTIONS_MAP
-from .models import SoftClippedRead
-from .utils import cached, consume_lines, filter_nested_dict, index_bam_file, sum_nested_dicts, multiprocess_over_dict
-from .constants import CACHE_DIR, LOG_DIR, STRAND_PYSAM_ARGS
+from .models import BAMRegion
+from .utils import cached, consume_lines, index_bam_file, iter_multiprocess_over_dict, merge_truncation_points, \
+    read_truncation_points, truncation_points_exist, write_truncation_points
+from .constants import CACHE_DIR, LOG_DIR, STRAND_SAM_FLAGS, TASK_RETRIES
 
 
 class BAMSplitter:
     def __init__(self, bam_basename, args):
         self.basename = bam_basename
         self.args = args
-        self.pbar = None
 
     def process(self):
         self.split_strands()
         if not self.args.skip_soft_clip:
-            self.split_read_groups()
+            if self.args.split_read_groups:
+                self.split_read_groups()
+            else:
+                self.shard_strand_regions()
             self.pileup_soft_clipped_reads()
-        # TODO make this an optional step as it's a bit of a bottleneck for little gain.
-        self.find_zero_coverage_intervals()
+        if not self.args.lazy_coverage_gaps:
+            self.find_zero_coverage_intervals()
 
     def split_strands(self):
         self.gap_outputs = {}
+        strand_outputs = {}
         for strand in ["forward", "reverse"]:
             output_file = cached(self.basename + '.%s.bam' % strand)
             if not os.path.isfile(output_file):
-                logging.info("Splitting %s strand from %s." % (strand, self.args.BAM_IN))
-                try:
-                    pysam.view(
-                        "--threads", str(self.args.processors),
-                        "-b", *STRAND_PYSAM_ARGS[strand],
-                        "-o", output_file,
-                        self.args.BAM_IN, catch_stdout=False)
-                except TypeError as e:
-                    logging.error("pysam returned an error: %s" % e)
-                    raise
-                else:
-                    logging.info("Finished splitting %s strand." % strand)
+                strand_outputs[strand] = output_file
             else:
                 logging.info("Using cached %s strand BAM file." % strand)
             self.gap_outputs[output_file] = cached("%s_coverage_gaps.bed" % strand)
         self.gap_outputs_to_process = self.gap_outputs.copy()
+        if strand_outputs:
+            logging.info("Splitting %s strand(s) from %s." % (" and ".join(strand_outputs), self.args.BAM_IN))
+            self._demultiplex_strands(strand_outputs)
+            logging.info("Finished splitting strands.")
+        # Indexes allow stranded BAM files to be processed by region.
+        for output_file in self.gap_outputs:
+            index_bam_file(output_file, self.args.processors)
+
+    def _demultiplex_strands(self, strand_outputs):
+        """
+        Route every read of BAM_IN to its stranded BAM file in a single pass, so that the input only has to be
+        decompressed once. BGZF compression threads are shared between the output files.
+        """
+        threads = max(1, self.args.processors // len(strand_outputs))
+        try:
+            with pysam.AlignmentFile(self.args.BAM_IN, "rb", threads=self.args.processors) as bam_in:
+                outputs = {
+                    strand: pysam.AlignmentFile(output_file, "wb", template=bam_in, threads=threads)
+                    for strand, output_file in strand_outputs.items()}
+                try:
+                    forward, reverse = outputs.get("forward"), outputs.get("reverse")
+                    for seg in bam_in.fetch(until_eof=True):
+                        flag = seg.flag
+                        if flag & STRAND_SAM_FLAGS["reverse"]:
+                            if reverse:
+                                reverse.write(seg)
+                        elif forward and not flag & STRAND_SAM_FLAGS["forward"]:
+                            forward.write(seg)
+                finally:
+                    for output in outputs.values():
+                        output.close()
+        except (OSError, ValueError) as e:
+            logging.error("pysam returned an error: %s" % e)
+            for output_file in strand_outputs.values():
+                if os.path.isfile(output_file):
+                    os.remove(output_file)
+            raise
 
     @staticmethod
     def num_read_groups(bam):
@@ -59,6 +89,9 @@ class BAMSplitter:
         return len([h for h in header if h.startswith("@RG")])
 
     def split_read_groups(self):
+        """
+        Split stranded BAM files into one BAM file per read-group, each of which is a SPAT pileup task.
+        """
         for strand in ["forward", "reverse"]:
             input_bam = cached(self.basename + '.%s.bam' % strand)
             if len(glob(cached(self.basename + ".%s_*.bam" % strand))) < self.num_read_groups(input_bam):
@@ -70,77 +103,150 @@ class BAMSplitter:
                                       key=lambda x: os.stat(x).st_size,
                                       reverse=True)
         self.spat_outputs = {
-            bf: cached(re.search(r'%s.(.*).bam$' % self.basename, os.path.basename(bf)).group(1) + "_unmapped.json")
+            BAMRegion(bf): cached(re.search(r'%s.(.*).bam$' % self.basename, os.path.basename(bf)).group(1) +
+                                  "_truncation_points.npy")
             for bf in self.read_group_bams}
-        self.spat_outputs_to_process = self.spat_outputs.copy()
-
-    def _get_max_reads_for_pbar(self):
-        max_reads = 0
-        for bf in self.read_group_bams:
-            if not os.path.isfile(self.spat_outputs[bf]):
-                index_bam_file(bf, self.args.processors)
-                idxstats = pysam.idxstats(bf).split('\n')
-                num_reads = sum([int(chr.split("\t")[2]) + int(chr.split("\t")[3]) for chr in idxstats[:-1]])
-                if num_reads > max_reads:
-                    max_reads = num_reads
-                    self.max_bam = bf
-            else:
-                del self.spat_outputs_to_process[bf]
-        return max_reads
+        self.spat_weights = {}
+        for region, output in self.spat_outputs.items():
+            if not truncation_points_exist(output):
+                index_bam_file(region.bam, self.args.processors)
+                idxstats = pysam.idxstats(region.bam).split('\n')
+                self.spat_weights[region] = sum([int(chr.split("\t")[2]) + int(chr.split("\t")[3])
+                                                 for chr in idxstats[:-1]])
+
+    def shard_strand_regions(self):
+        """
+        Shard indexed stranded BAM files into regions of at most --spat-region-size bases (or whole chromosomes),
+        each of which is a SPAT pileup task. Weight each region by its expected number of mapped reads.
+        """
+        self.spat_outputs = {}
+        self.spat_weights = {}
+        for strand in ["forward", "reverse"]:
+            input_bam = cached(self.basename + '.%s.bam' % strand)
+            with pysam.AlignmentFile(input_bam, "rb") as samfile:
+                for stat in samfile.get_index_statistics():
+                    if not stat.mapped:
+                        continue
+                    length = samfile.get_reference_length(stat.contig)
+                    size = self.args.spat_region_size or length
+                    for start in range(0, length, size):
+                        region = BAMRegion(input_bam, stat.contig, start, min(start + size, length))
+                        # Named by region, so that cached shards are only reused for the same coordinates.
+                        self.spat_outputs[region] = cached("%s_%s_%d_%d_truncation_points.npy" % (
+                            strand, re.sub(r"[^\w.-]", "_", stat.contig), region.start, region.end))
+                        self.spat_weights[region] = max(1, stat.mapped * (region.end - region.start) // length)
 
     def pileup_soft_clipped_reads(self):
-        if not os.path.isfile(cached("forward_unmapped.json")) or not os.path.isfile(cached("reverse_unmapped.json")):
-            max_reads = self._get_max_reads_for_pbar()
-            if self.spat_outputs_to_process and max_reads > 0:
-                with tqdm(total=max_reads,
+        if not truncation_points_exist(cached("forward_truncation_points.npy")) or \
+                not truncation_points_exist(cached("reverse_truncation_points.npy")):
+            strand_outputs = {"forward": [], "reverse": []}
+            spat_outputs_to_process = {}
+            for region, output in self.spat_outputs.items():
+                if truncation_points_exist(output):
+                    self._load_spat_output(strand_outputs, output)
+                else:
+                    spat_outputs_to_process[region] = output
+            if spat_outputs_to_process:
+                # Outputs are loaded as each task completes, largest first.
+                with tqdm(total=sum(self.spat_weights[region] for region in spat_outputs_to_process),
                           desc=f'{"INFO": <8} Iterating over reads to determine SPAT pileups',
-                          bar_format='{l_bar}{bar}| [{elapsed}<{remaining}]') as self.pbar:
-                    multiprocess_over_dict(self._count_unmapped_pileups, self.spat_outputs_to_process)
+                          bar_format='{l_bar}{bar}| [{elapsed}<{remaining}]') as pbar:
+                    for region, output, _ in iter_multiprocess_over_dict(self._count_unmapped_pileups,
+                                                                         spat_outputs_to_process,
+                                                                         processors=self.args.processors,
+                                                                         retries=TASK_RETRIES,
+                                                                         size=self.spat_weights.get):
+                        self._load_spat_output(strand_outputs, output)
+                        pbar.update(self.spat_weights[region])
 
             logging.info('Merging SPAT outputs.')
-            for strand in ["forward", "reverse"]:
-                strand_output = {}
-                for output in self.spat_outputs.values():
-                    if strand in os.path.basename(output):
-                        with open(output, 'r') as f:
-                            strand_output = sum_nested_dicts(strand_output, json.load(f))
-                with open(cached("%s_unmapped.json" % strand), "w") as f:
-                    json.dump(filter_nested_dict(strand_output, self.args.min_pileups), f)
+            for strand, strand_output in strand_outputs.items():
+                write_truncation_points(cached("%s_truncation_points.npy" % strand),
+                                        merge_truncation_points(strand_output, self.args.min_pileups))
         else:
             logging.info("Using cached SPAT pileups.")
 
-    def _count_unmapped_pileups(self, bam_file, output_file):
-        samfile = pysam.AlignmentFile(bam_file, "rb")
-        unmapped = defaultdict(lambda: defaultdict(int))
-        for seg in samfile.fetch(until_eof=True):
-            read = SoftClippedRead(
-                chr=seg.reference_name,
-                start=seg.reference_start,
-                end=seg.reference_end,
-                cigar=seg.cigarstring,
-                seq=seg.query_sequence,
-                strand="reverse" if seg.is_reverse else "forward")
-            if read.poly_tail_exists(self.args.min_poly_tail):
-                unmapped[read.chr][read.extremity] += 1
-            if bam_file == self.max_bam:
-                self.pbar.update()
-
-        with open(output_file, "w") as f:
-            json.dump(unmapped, f)
+    @staticmethod
+    def _load_spat_output(strand_outputs, output):
+        for strand in strand_outputs:
+            if os.path.basename(output).startswith(strand + "_"):
+                strand_outputs[strand].append(read_truncation_points(output))
+
+    def _count_unmapped_pileups(self, region, output_file):
+        samfile = pysam.AlignmentFile(region.bam, "rb")
+        unmapped = count_poly_tail_truncation_points(samfile, region.fetch(samfile), self.args.min_poly_tail)
+        write_truncation_points(output_file, unmapped)
 
     def find_zero_coverage_intervals(self):
         if not os.path.isfile(cached("forward_coverage_gaps.bed")) or not os.path.isfile(cached("reverse_coverage_gaps.bed")):
             logging.info('Filtering intervals with zero coverage.')
-            multiprocess_over_dict(self._find_zero_coverage_intervals, self.gap_outputs_to_process)
+            chr_regions = {}
+            chr_weights = {}
+            for bam_file, output_file in self.gap_outputs_to_process.items():
+                with pysam.AlignmentFile(bam_file, "rb") as samfile:
+                    mapped = {stat.contig: stat.mapped for stat in samfile.get_index_statistics()}
+                    chr_regions[output_file] = [BAMRegion(bam_file, chr, 0, length)
+                                                for chr, length in zip(samfile.references, samfile.lengths)]
+                for region in chr_regions[output_file]:
+                    chr_weights[region] = mapped.get(region.chr, 0)
+            # Chromosomes without mapped reads are a single gap, so only process the others, each with a min_cov of 1.
+            gaps = {}
+            for region, _, intervals in iter_multiprocess_over_dict(
+                    self._find_zero_coverage_intervals,
+                    {region: 1 for region, weight in chr_weights.items() if weight},
+                    processors=self.args.processors,
+                    retries=TASK_RETRIES,
+                    size=chr_weights.get):
+                gaps[region] = intervals
+            for output_file, regions in chr_regions.items():
+                with open(output_file, "w") as f:
+                    for region in regions:
+                        write_bed(f, region.chr, *gaps.get(region, ([region.start], [region.end])))
         else:
             logging.info("Using cached zero coverage intervals.")
 
-    def _find_zero_coverage_intervals(self, bam_file, output_file, min_cov=1):
-        from pybedtools import BedTool
-        bed_tool = BedTool(bam_file)
-        bed = bed_tool.genome_coverage(bga=True, split=True)
-        gaps = bed.filter(lambda x: float(x.name) < min_cov).merge()
-        gaps.saveas(cached(output_file))
+    @staticmethod
+    def _find_zero_coverage_intervals(region, min_cov=1):
+        """
+        Equivalent to filtering `bedtools genomecov -bga -split` output of region for coverage lower than min_cov
+        and merging.
+        """
+        return zero_coverage_intervals(region.bam, region.chr, region.start, region.end, min_cov)
+
+
+def count_poly_tail_truncation_points(samfile, segments, tail_len=10):
+    """
+    Tally the extremity of every read in segments (from samfile) with a poly-A/T tail of tail_len bases in its
+    soft-clipped 3' end, per chromosome. Equivalent to SoftClippedRead.poly_tail_exists, but takes soft-clip lengths
+    from cigartuples so that the read sequence is only decoded for reads with a terminal soft-clip.
+    """
+    poly_a, poly_t = "A" * tail_len, "T" * tail_len
+    counts = defaultdict(int)
+    for seg in segments:
+        # Alignment boundaries exclude soft-clipped bases, so cheaply rule out reads without any first.
+        if seg.is_reverse:
+            if not seg.query_alignment_start or seg.is_unmapped:
+                continue
+            op, length = seg.cigartuples[0]
+            if op != pysam.CSOFT_CLIP:
+                continue
+            soft_clipped = (seg.query_sequence or "")[:length]
+            extremity = seg.reference_start + 1
+        else:
+            if seg.query_alignment_end == seg.query_length or seg.is_unmapped:
+                continue
+            op, length = seg.cigartuples[-1]
+            if op != pysam.CSOFT_CLIP:
+                continue
+            soft_clipped = (seg.query_sequence or "")[-length:]
+            extremity = seg.reference_end
+        if poly_t in soft_clipped or poly_a in soft_clipped:
+            counts[seg.reference_id, extremity] += 1
+
+    unmapped = {}
+    for (tid, extremity), count in counts.items():
+        unmapped.setdefault(samfile.get_reference_name(tid), {})[extremity] = count
+    return unmapped
 
 
 async def create_db(gff_in):
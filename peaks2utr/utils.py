@@ -1,17 +1,25 @@
 import argparse
+import collections
+import heapq
+import itertools
+import json
 import logging
 import multiprocessing
+from multiprocessing.connection import wait
+import operator
 import os.path
-from queue import Empty
+import pathlib
 import re
 import resource
 import sqlite3
 
+import gffutils
+import numpy as np
 import pysam
 
-from .constants import FeatureTypes, CACHE_DIR
+from .constants import FeatureTypes, CACHE_DIR, SPAT_DTYPE
 from .exceptions import EXCEPTIONS_MAP
-from .models import FeatureDB
+from .models import FeatureDB, UTR
 
 
 class CustomArgumentParser(argparse.ArgumentParser):
@@ -48,11 +56,14 @@ class Falsey:
 
 
 class Counter:
+    """
+    Count of distinct keys, such as peak names. Counting is local to each process, without locking, so Counters of
+    worker processes are reduced into those of the parent with update.
+    """
     seen = set()
 
     def __init__(self):
-        self.val = multiprocessing.Value('i', 0)
-        self.lock = multiprocessing.Lock()
+        self.keys = set()
 
     def __int__(self):
         return self.value
@@ -62,22 +73,30 @@ class Counter:
         Add key to global seen set. This Counter will only increment if key is not a duplicate in _any_ Counter.
         """
         if key not in self.seen:
-            with self.lock:
-                self.val.value += 1
-                self.seen.add(key)
+            self.seen.add(key)
+            self.keys.add(key)
+
+    def update(self, keys):
+        """
+        Add keys counted by a Counter of another process.
+        """
+        for key in keys:
+            self.add(key)
 
     @property
     def value(self):
-        with self.lock:
-            return self.val.value
+        return len(self.keys)
 
 
 def cached(filename):
     return os.path.join(CACHE_DIR, os.path.basename(filename))
 
 
-def connect_db(db_path):
-    db = sqlite3.connect(db_path, check_same_thread=False)
+def connect_db(db_path, read_only=False):
+    if read_only:
+        db = sqlite3.connect(pathlib.Path(db_path).absolute().as_uri() + "?mode=ro", uri=True, check_same_thread=False)
+    else:
+        db = sqlite3.connect(db_path, check_same_thread=False)
     return FeatureDB(db)
 
 
@@ -96,21 +115,86 @@ async def consume_lines(pipe, log_file):
             f.write(line)
 
 
-def multiprocess_over_dict(f, d):
+def multiprocess_over_dict(f, d, processors=None, retries=0, size=None):
+    """
+    Call function f for every key-value pair in d in a bounded pool of multiprocessing Processes, passing this item
+    as the function's arguments. See iter_multiprocess_over_dict.
+    Wait for them all to finish before returning.
+    """
+    for _ in iter_multiprocess_over_dict(f, d, processors, retries, size):
+        pass
+
+
+def iter_multiprocess_over_dict(f, d, processors=None, retries=0, size=None):
     """
     Assign a multiprocessing Process to call function f for every key-value pair in d, passing this item
-    as the function's first argument.
-    Start each process and wait for them all to finish before returning.
+    as the function's first and second arguments. At most `processors` Processes (default: one per item) run at once.
+    Items are scheduled largest first if a size function of the key is given, otherwise in dict order.
+    A call whose Process exits abnormally is retried up to `retries` times before raising.
+    Yield (key, value, result) as each call completes, so that results can be consumed while others are running.
+    """
+    pending = collections.deque(sorted(d.items(), key=lambda x: size(x[0]), reverse=True) if size else d.items())
+    processors = max(1, processors or len(pending))
+    attempts = collections.Counter()
+    running = {}
+    try:
+        while pending or running:
+            while pending and len(running) < processors:
+                job = _PoolJob(f, *pending.popleft())
+                running[job.process.sentinel] = job
+            readers = {job.reader: job for job in running.values() if not job.reader.closed}
+            for ready in wait(list(readers) + list(running)):
+                if ready in readers:
+                    readers[ready].receive()
+                elif ready in running:
+                    job = running.pop(ready)
+                    job.receive()
+                    job.process.join()
+                    if job.process.exitcode == 0:
+                        yield job.input, job.output, job.result
+                    elif attempts[job.input] < retries:
+                        attempts[job.input] += 1
+                        logging.warning("%s failed for %s with exit code %s. Retrying."
+                                        % (f.__name__, job.input, job.process.exitcode))
+                        pending.appendleft((job.input, job.output))
+                    else:
+                        raise EXCEPTIONS_MAP.get(f.__name__, Exception)
+    finally:
+        for job in running.values():
+            job.process.terminate()
+            job.receive()
+
+
+class _PoolJob:
+    """
+    A Process calling f(input, output), with the return value sent back over a pipe.
     """
-    jobs = []
-    for input, output in d.items():
-        p = multiprocessing.Process(target=f, args=(input, output))
-        jobs.append(p)
-        p.start()
-    for job in jobs:
-        job.join()
-        if job.exitcode != 0:
-            raise EXCEPTIONS_MAP.get(f.__name__, Exception)
+    def __init__(self, f, input, output):
+        self.input = input
+        self.output = output
+        self.result = None
+        self.reader, writer = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(target=self._send_result, args=(f, writer, input, output))
+        self.process.start()
+        writer.close()
+
+    @staticmethod
+    def _send_result(f, conn, *args):
+        conn.send(f(*args))
+        conn.close()
+
+    def receive(self):
+        """
+        Read the result if it has been sent, closing the pipe once it has been read or the Process has exited.
+        """
+        if self.reader.closed:
+            return
+        try:
+            if self.reader.poll():
+                self.result = self.reader.recv()
+        except EOFError:
+            pass
+        self.reader.close()
 
 
 def format_stats_line(msg, total, numerator=None):
@@ -125,29 +209,17 @@ def format_stats_line(msg, total, numerator=None):
     return msg
 
 
-def iter_batches(lst, n):
-    """
-    Yield successive n-sized chunks from lst.
-    """
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
-
-
-def yield_from_process(q, p, pbar=None):
+def balance_shards(weights, n):
     """
-    Yield items in queue q while each process p is alive. This prevents program from locking up when queue
-    gets too large.
-    Pass an optional tqdm progress bar (pbar) to keep a single progress bar running over multiple processes.
+    Assign keys of weights to at most n batches balanced by total weight, taking keys heaviest first and assigning
+    each to the lightest batch so far (longest processing time first). Return list of non-empty batches of keys.
     """
-    while p.is_alive():
-        p.join(timeout=1)
-        while True:
-            try:
-                yield q.get(block=False)
-                if pbar:
-                    pbar.update()
-            except Empty:
-                break
+    batches = [(0, idx, []) for idx in range(n)]
+    for key in sorted(weights, key=weights.get, reverse=True):
+        weight, idx, keys = heapq.heappop(batches)
+        keys.append(key)
+        heapq.heappush(batches, (weight + weights[key], idx, keys))
+    return [keys for _, _, keys in sorted(batches, key=lambda x: x[1]) if keys]
 
 
 def limit_memory(maxsize):
@@ -158,45 +230,98 @@ def limit_memory(maxsize):
     resource.setrlimit(resource.RLIMIT_AS, (int(maxsize), hard))
 
 
-def filter_nested_dict(node, threshold):
+def write_truncation_points(fn, truncation_points):
     """
-    For an n-nested dictionary, filter out integer leaves with a minimum threshold value.
+    Write SPAT truncation points, given as {chr: {position: count}} or {chr: (positions, counts)}, to a binary store of
+    (pos, count) records sorted by position within each chromosome. See write_records.
     """
-    if isinstance(node, int):
-        if node >= threshold:
-            return node
-    else:
-        dupe_node = {}
-        for k, v in node.items():
-            cur_node = filter_nested_dict(v, threshold)
-            if cur_node:
-                dupe_node[k] = cur_node
-        return dupe_node or None
+    records = {}
+    for chr, points in truncation_points.items():
+        if isinstance(points, dict):
+            positions = np.fromiter(map(int, points.keys()), dtype=np.int64, count=len(points))
+            counts = np.fromiter(points.values(), dtype=np.int64, count=len(points))
+        else:
+            positions, counts = points
+        order = np.argsort(positions, kind="stable")
+        records[chr] = np.empty(len(order), dtype=SPAT_DTYPE)
+        records[chr]["pos"] = np.asarray(positions)[order]
+        records[chr]["count"] = np.asarray(counts)[order]
+    write_records(fn, records, SPAT_DTYPE)
+
+
+def read_truncation_points(fn, mmap=True):
+    """
+    Read {chr: records} of SPAT truncation points from binary store fn. Records are memory-mapped unless mmap is False.
+    """
+    return read_records(fn, mmap)
 
 
-def sum_nested_dicts(d1, d2):
+def truncation_points_exist(fn):
+    return os.path.isfile(fn) and os.path.isfile(_records_index_fn(fn))
+
+
+def write_records(fn, records, dtype):
     """
-    For an n-nested dictionary, sum numeric values in leaves with matching keys.
+    Write {chr: records} of given numpy dtype to a compact binary store: a .npy file fn of the records of each
+    chromosome in turn, and a json index of the records belonging to each chromosome.
     """
-    def sum(v1, v2):
-        if v2 is None:
-            return v1
-        try:
-            return v1 + v2
-        except TypeError:
-            return sum_nested_dicts(v1, v2)
-    result = d2.copy()
-    result.update({k: sum(v, d2.get(k)) for k, v in d1.items()})
-    return result
+    index = {}
+    offset = 0
+    for chr, chr_records in records.items():
+        index[chr] = [offset, offset + len(chr_records)]
+        offset += len(chr_records)
+    np.save(fn, np.concatenate(list(records.values())) if records else np.empty(0, dtype=dtype))
+    with open(_records_index_fn(fn), "w") as f:
+        json.dump(index, f)
+
+
+def read_records(fn, mmap=True):
+    """
+    Read {chr: records} from binary store fn. Records are memory-mapped unless mmap is False, so that processes
+    reading the same store share its pages.
+    """
+    with open(_records_index_fn(fn), "r") as f:
+        index = json.load(f)
+    records = np.load(fn, mmap_mode="r" if mmap and index else None)
+    return {chr: records[start:end] for chr, (start, end) in index.items()}
+
 
+def _records_index_fn(fn):
+    return os.path.splitext(fn)[0] + ".idx.json"
 
-def features_dict_for_gene(db, gene, transcript=None):
+
+def merge_truncation_points(stores, min_pileups=1):
+    """
+    Sum counts of matching truncation points over {chr: records} stores, keeping those with at least min_pileups.
+    Return {chr: (positions, counts)}.
+    """
+    chr_records = collections.defaultdict(list)
+    for store in stores:
+        for chr, records in store.items():
+            chr_records[chr].append(records)
+    merged = {}
+    for chr, records in chr_records.items():
+        records = np.concatenate(records)
+        records = records[np.argsort(records["pos"], kind="stable")]
+        if not len(records):
+            continue
+        first = np.flatnonzero(np.diff(records["pos"], prepend=records["pos"][0] - 1))
+        positions = records["pos"][first]
+        counts = np.add.reduceat(records["count"], first)
+        keep = counts >= min_pileups
+        if keep.any():
+            merged[chr] = (positions[keep], counts[keep])
+    return merged
+
+
+def features_dict_for_gene(db, gene, transcript=None, children=None):
     """
     Return a dictionary containing gene and all its child features.
-    Pass an optional transcript when 3' UTR has been annotated to allow extension.
+    Pass an optional transcript when 3' UTR has been annotated to allow extension, and optional children of gene as
+    from db.children (see children_of_genes) to save querying db.
     """
     features = {"gene": gene}
-    for idx, f in enumerate(db.children(gene)):
+    for idx, f in enumerate(db.children(gene) if children is None else children):
         if f.id != gene.id:
             if transcript and f.id == transcript.id:
                 features.update({"transcript": transcript})
@@ -205,6 +330,40 @@ def features_dict_for_gene(db, gene, transcript=None):
     return features
 
 
+def children_of_genes(db, featuretypes):
+    """
+    Yield (gene id, child features) of genes of featuretypes that have children, in file order of genes, each ordered
+    as by db.children. Read as a single ordered pass over db, streamed one gene at a time, rather than a query per gene.
+    """
+    rows = db.conn.execute(
+        "SELECT DISTINCT relations.parent AS parent, %s, features.rowid AS file_order FROM features AS genes "
+        "JOIN relations ON relations.parent = genes.id "
+        "JOIN features ON relations.child = features.id "
+        "WHERE genes.featuretype IN (%s) "
+        "ORDER BY genes.rowid, relations.child" % (
+            ", ".join("features." + k for k in gffutils.constants._keys), ", ".join("?" * len(featuretypes))),
+        featuretypes)
+    for parent, group in itertools.groupby(map(dict, rows), key=operator.itemgetter("parent")):
+        yield parent, [db._feature_returner(**{k: v for k, v in row.items() if k != "parent"}) for row in group]
+
+
+def features_dict_for_utr(db, gene, annotated_utr, gtf_in=False, children=None):
+    """
+    Return a dictionary containing gene and all its child features, including the new 3' UTR of annotated_utr to
+    which its gene and transcript are extended. Pass optional children of gene as for features_dict_for_gene.
+    """
+    transcript = db[annotated_utr.transcript_id]
+    utr = UTR(annotated_utr.start, annotated_utr.end)
+    utr.generate_feature(gene, transcript, db, annotated_utr.colour, gtf_in)
+    features = features_dict_for_gene(db, gene, transcript, children)
+    features.update({"utr": utr.feature})
+    if gene.strand == "+":
+        gene.end = transcript.end = utr.end
+    else:
+        gene.start = transcript.start = utr.start
+    return features
+
+
 def get_output_filename(args):
     gff_base, gff_ext = os.path.splitext(args.GFF_IN)
     gff_basename = os.path.basename(gff_base)
@@ -8,7 +8,7 @@ import gffutils
 from peaks2utr import prepare_argparser
 from peaks2utr.annotations import AnnotationsPipeline, NoNearbyFeatures, PotentialUTRZeroCoverage
 from peaks2utr.collections import AnnotationsDict, BroadPeaksList, ZeroCoverageIntervalsDict, SPATTruncationPointsDict
-from peaks2utr.models import UTR, FeatureDB
+from peaks2utr.models import AnnotatedUTR, UTR, FeatureDB
 
 TEST_DIR = os.path.dirname(__file__)
 
@@ -48,11 +48,11 @@ class TestCase2(unittest.TestCase):
                     annotations = AnnotationsDict()
                     while not pipeline.queue.empty():
                         result = pipeline.queue.get()
-                        if type(result) == dict:
-                            annotations.update(result)
+                        if isinstance(result, AnnotatedUTR):
+                            annotations.add_utr(result)
                     for gene in expected_annotations[peak.name].keys():
-                        self.assertIn(gene, annotations)
-                        self.assertEqual(annotations.data[gene]['utr'].range, expected_annotations[peak.name][gene].range)
+                        self.assertIn(gene, annotations.utrs)
+                        self.assertEqual(annotations.utrs[gene].range, expected_annotations[peak.name][gene].range)
 
     def test_override_utr(self):
         self.args.max_distance = 5000
@@ -68,8 +68,8 @@ class TestCase2(unittest.TestCase):
                 result = pipeline.queue.get()
                 if result:
                     for gene in expected_annotations[peak.name].keys():
-                        self.assertIn(gene, result)
-                        self.assertEqual(expected_annotations[peak.name][gene].range, result[gene]["utr"].range)
+                        self.assertEqual(gene, result.gene_id)
+                        self.assertEqual(expected_annotations[peak.name][gene].range, result.range)
                 else:
                     assert expected_annotations[peak.name] is None
 
@@ -8,7 +8,7 @@ import gffutils
 from peaks2utr import prepare_argparser
 from peaks2utr.annotations import AnnotationsPipeline, NoNearbyFeatures, PotentialUTRZeroCoverage
 from peaks2utr.collections import AnnotationsDict, BroadPeaksList, ZeroCoverageIntervalsDict, SPATTruncationPointsDict
-from peaks2utr.models import FeatureDB
+from peaks2utr.models import AnnotatedUTR, FeatureDB
 
 TEST_DIR = os.path.dirname(__file__)
 
@@ -52,11 +52,11 @@ class TestCase3(unittest.TestCase):
                     annotations = AnnotationsDict()
                     while not pipeline.queue.empty():
                         result = pipeline.queue.get()
-                        if type(result) == dict:
-                            annotations.update(result)
+                        if isinstance(result, AnnotatedUTR):
+                            annotations.add_utr(result)
                     for gene in expected_annotations[peak.name].keys():
-                        self.assertIn(gene, annotations)
-                        self.assertEqual(annotations.data[gene]['utr'].range, expected_annotations[peak.name][gene].range)
+                        self.assertIn(gene, annotations.utrs)
+                        self.assertEqual(annotations.utrs[gene].range, expected_annotations[peak.name][gene].range)
 
 
 if __name__ == '__main__':
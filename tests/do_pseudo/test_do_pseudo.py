@@ -61,8 +61,8 @@ class TestDoPseudo(unittest.TestCase):
                 result = pipeline.queue.get()
                 if result:
                     for gene in expected_annotations[peak.name].keys():
-                        self.assertIn(gene, result)
-                        self.assertEqual(expected_annotations[peak.name][gene].range, result[gene]["utr"].range)
+                        self.assertEqual(gene, result.gene_id)
+                        self.assertEqual(expected_annotations[peak.name][gene].range, result.range)
                 else:
                     assert expected_annotations[peak.name] is None
         
@@ -8,7 +8,7 @@ import gffutils
 from peaks2utr import prepare_argparser
 from peaks2utr.annotations import AnnotationsPipeline
 from peaks2utr.collections import AnnotationsDict, BroadPeaksList, ZeroCoverageIntervalsDict, SPATTruncationPointsDict
-from peaks2utr.models import UTR, FeatureDB
+from peaks2utr.models import AnnotatedUTR, UTR, FeatureDB
 
 TEST_DIR = os.path.dirname(__file__)
 
@@ -38,11 +38,11 @@ class TestNoStrandOverlap(unittest.TestCase):
                 annotations = AnnotationsDict()
                 while not pipeline.queue.empty():
                     result = pipeline.queue.get()
-                    if type(result) == dict:
-                        annotations.update(result)
+                    if isinstance(result, AnnotatedUTR):
+                        annotations.add_utr(result)
                 for gene in expected_annotations[peak.name].keys():
-                    self.assertIn(gene, annotations)
-                    self.assertEqual(annotations.data[gene]['utr'].range, expected_annotations[peak.name][gene].range)
+                    self.assertIn(gene, annotations.utrs)
+                    self.assertEqual(annotations.utrs[gene].range, expected_annotations[peak.name][gene].range)
 
     def test_utr_no_overlap(self):
         args = self.argparser.parse_args(["", "", "--max-distance", "2000", "--no-strand-overlap"])
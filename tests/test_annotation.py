@@ -1,14 +1,23 @@
+from contextlib import ExitStack
+import itertools
 import os
 import os.path
 from queue import Queue
+import tempfile
 import unittest
+from unittest.mock import patch
 
 import gffutils
+import numpy as np
 
-from peaks2utr import prepare_argparser
+from peaks2utr import criteria, prepare_argparser
+from peaks2utr.constants import AnnotationColour, STRAND_MAP
 from peaks2utr.annotations import AnnotationsPipeline, NoNearbyFeatures
-from peaks2utr.models import UTR, FeatureDB
-from peaks2utr.collections import AnnotationsDict, BroadPeaksList, ZeroCoverageIntervalsDict, SPATTruncationPointsDict
+from peaks2utr.models import AnnotatedUTR, UTR, FeatureDB
+from peaks2utr.postprocess import merge_annotations, write_pass_through_annotations, write_sorted_annotations
+from peaks2utr.utils import Counter
+from peaks2utr.collections import AnnotationIndex, AnnotationsDict, BroadPeaksList, ZeroCoverageIntervalsDict, \
+    SPATTruncationPointsDict
 
 TEST_DIR = os.path.dirname(__file__)
 
@@ -43,11 +52,11 @@ class TestUTRAnnotation(unittest.TestCase):
                     annotations = AnnotationsDict()
                     while not pipeline.queue.empty():
                         result = pipeline.queue.get()
-                        if type(result) == dict:
-                            annotations.update(result)
+                        if isinstance(result, AnnotatedUTR):
+                            annotations.add_utr(result)
                     for gene in expected_annotations[peak.name].keys():
-                        self.assertIn(gene, annotations)
-                        self.assertEqual(annotations.data[gene]['utr'].range, expected_annotations[peak.name][gene].range)
+                        self.assertIn(gene, annotations.utrs)
+                        self.assertEqual(annotations.utrs[gene].range, expected_annotations[peak.name][gene].range)
 
     def test_forward_strand_annotations(self):
         expected_annotations = {
@@ -62,6 +71,16 @@ class TestUTRAnnotation(unittest.TestCase):
         peaks_filename = os.path.join(TEST_DIR, "test_forward_peaks.broadPeak")
         self.strand_annotations(peaks_filename, 'forward', expected_annotations)
 
+    def test_spat_truncation_points(self):
+        self.truncation_points = SPATTruncationPointsDict(
+            {"Pb1219_15UTR_PbANKA_01_v3": {"16000": 10, "15000": 12, "20000": 11}})
+        expected_annotations = {
+            # Up to highest truncation point within UTR
+            'forward_peak_6': {'PBANKA_0100041.1': UTR(14119, 16000)},
+        }
+        peaks_filename = os.path.join(TEST_DIR, "test_forward_peaks.broadPeak")
+        self.strand_annotations(peaks_filename, 'forward', expected_annotations)
+
     def test_reverse_strand_annotations(self):
         expected_annotations = {
             # Up to end of reverse_peak_1
@@ -87,6 +106,279 @@ class TestUTRAnnotation(unittest.TestCase):
         peaks_filename = os.path.join(TEST_DIR, "test_reverse_peaks.broadPeak")
         self.strand_annotations(peaks_filename, 'reverse', expected_annotations)
 
+    @staticmethod
+    def fresh_counters():
+        """
+        Count criteria fails afresh within context.
+        """
+        stack = ExitStack()
+        for f in criteria.BATCH_CRITERIA.values():
+            stack.enter_context(patch.object(f, "fails", Counter()))
+        stack.enter_context(patch.object(Counter, "seen", set()))
+        return stack
+
+    def annotate_all(self, db, sweep=False):
+        results = []
+        with self.fresh_counters():
+            results.extend(self._annotate_all(db, sweep))
+            results.append([int(f.fails) for f in criteria.BATCH_CRITERIA.values()])
+        return results
+
+    def _annotate_all(self, db, sweep):
+        results = []
+        for strand in ["forward", "reverse"]:
+            peaks = BroadPeaksList(broadpeak_fn=os.path.join(TEST_DIR, "test_%s_peaks.broadPeak" % strand), strand=strand)
+            pipeline = AnnotationsPipeline(peaks, self.args, queue=Queue())
+            # Annotate twice, so that coordinates modified by criteria must not leak into the index.
+            if sweep:
+                pipeline._sweep_peaks(db, list(peaks) * 2, {"+": self.truncation_points, "-": self.truncation_points},
+                                      {"+": self.coverage_gaps, "-": self.coverage_gaps})
+            else:
+                for peak in list(peaks) * 2:
+                    pipeline.annotate_utr_for_peak(db, peak, self.truncation_points, self.coverage_gaps)
+            while not pipeline.queue.empty():
+                result = pipeline.queue.get()
+                results.append(result if isinstance(result, AnnotatedUTR) else type(result))
+            results.append((int(pipeline.no_features_counter), int(pipeline.zero_coverage_removal_counter)))
+        return results
+
+    def test_annotation_index(self):
+        self.assertListEqual(self.annotate_all(AnnotationIndex(self.db)), self.annotate_all(self.db))
+
+    def test_sweep(self):
+        self.coverage_gaps = ZeroCoverageIntervalsDict({
+            "Pb1219_15UTR_PbANKA_01_v3": (np.array([14000, 30001, 45001]), np.array([17500, 31000, 46000]))})
+        self.truncation_points = SPATTruncationPointsDict({"Pb1219_15UTR_PbANKA_01_v3": {"33000": 10, "438000": 10}})
+        for batch_criteria, no_strand_overlap, five_prime_ext, max_distance, override_utr in itertools.product(
+                [False, True], [False, True], [0, 100], [2500, 0], [False, True]):
+            self.args.batch_criteria = batch_criteria
+            self.args.no_strand_overlap = no_strand_overlap
+            self.args.five_prime_ext = five_prime_ext
+            self.args.max_distance = max_distance
+            self.args.override_utr = override_utr
+            self.assertListEqual(self.annotate_all(AnnotationIndex(self.db), sweep=True), self.annotate_all(self.db))
+
+    def test_pipeline_processes(self):
+        self.args.processors = 3
+        self.args.skip_soft_clip = True
+        peaks = BroadPeaksList()
+        for strand in ["forward", "reverse"]:
+            peaks += BroadPeaksList(broadpeak_fn=os.path.join(TEST_DIR, "test_%s_peaks.broadPeak" % strand), strand=strand)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for strand in ["forward", "reverse"]:
+                with open(os.path.join(cache_dir, "%s_coverage_gaps.bed" % strand), "w") as f:
+                    f.writelines("Pb1219_15UTR_PbANKA_01_v3\t%d\t%d\n" % gap
+                                 for gap in [(13999, 17500), (30000, 31000), (45000, 46000)])
+            expected = AnnotationsDict()
+            pipeline = AnnotationsPipeline(peaks, self.args, queue=Queue())
+            coverage_gaps = ZeroCoverageIntervalsDict(bed_fn=os.path.join(cache_dir, "forward_coverage_gaps.bed"))
+            with self.fresh_counters():
+                for peak in peaks:
+                    pipeline.annotate_utr_for_peak(self.db, peak, self.truncation_points, coverage_gaps)
+                expected_counts = [int(counter) for counter in pipeline.counters]
+            while not pipeline.queue.empty():
+                result = pipeline.queue.get()
+                if result:
+                    expected.add_utr(result)
+            # Small chunks, so that workers steal from each other's shards.
+            for sweep, chunk_size in [(False, 16), (True, 16), (False, 1), (True, 3)]:
+                self.args.sweep = sweep
+                annotations = AnnotationsDict()
+                with patch("peaks2utr.utils.CACHE_DIR", cache_dir), \
+                        patch("peaks2utr.constants.PEAK_CHUNK_SIZE", chunk_size), \
+                        patch("peaks2utr.constants.MAX_PEAK_CHUNK_SIZE", chunk_size), \
+                        self.fresh_counters():
+                    with AnnotationsPipeline(peaks, self.args, db_path=os.path.join(TEST_DIR, "Chr1.db")) as pipeline:
+                        for result in pipeline.iter_results():
+                            if result:
+                                annotations.add_utr(result)
+                    # Every peak reported as progress once.
+                    self.assertEqual(pipeline.pbar.n, len(peaks))
+                    self.assertListEqual(sorted(pipeline.worker_seconds), [0, 1, 2])
+                    self.assertTrue(all(seconds >= 0 for seconds in pipeline.worker_seconds.values()))
+                    self.assertListEqual([int(counter) for counter in pipeline.counters], expected_counts)
+                self.assertDictEqual(annotations.utrs, expected.utrs)
+
+    def test_sweep_pipeline(self):
+        self.args.processors = 2
+        self.args.skip_soft_clip = True
+        self.args.sweep = True
+        peaks = BroadPeaksList()
+        for strand in ["forward", "reverse"]:
+            peaks += BroadPeaksList(broadpeak_fn=os.path.join(TEST_DIR, "test_%s_peaks.broadPeak" % strand), strand=strand)
+        gaps = {"forward": [(13999, 17500), (30000, 31000)], "reverse": [(45000, 46000)]}
+        with tempfile.TemporaryDirectory() as cache_dir:
+            coverage_gaps = {}
+            for strand, symbol in STRAND_MAP.items():
+                bed_fn = os.path.join(cache_dir, "%s_coverage_gaps.bed" % strand)
+                with open(bed_fn, "w") as f:
+                    f.writelines("Pb1219_15UTR_PbANKA_01_v3\t%d\t%d\n" % gap for gap in gaps[strand])
+                coverage_gaps[symbol] = ZeroCoverageIntervalsDict(bed_fn=bed_fn)
+            expected = AnnotationsDict()
+            pipeline = AnnotationsPipeline(peaks, self.args, queue=Queue())
+            with self.fresh_counters():
+                for peak in peaks:
+                    pipeline.annotate_utr_for_peak(self.db, peak, self.truncation_points, coverage_gaps[peak.strand])
+            while not pipeline.queue.empty():
+                result = pipeline.queue.get()
+                if result:
+                    expected.add_utr(result)
+            annotations = AnnotationsDict()
+            with patch("peaks2utr.utils.CACHE_DIR", cache_dir), self.fresh_counters():
+                with AnnotationsPipeline(peaks, self.args, db_path=os.path.join(TEST_DIR, "Chr1.db")) as pipeline:
+                    for result in pipeline.iter_results():
+                        if result:
+                            annotations.add_utr(result)
+            self.assertEqual(pipeline.pbar.n, len(peaks))
+            self.assertTrue(annotations.utrs)
+            self.assertDictEqual(annotations.utrs, expected.utrs)
+
+    def test_merge_annotations(self):
+        peaks = BroadPeaksList(broadpeak_fn=os.path.join(TEST_DIR, "test_forward_peaks.broadPeak"), strand="forward")
+        annotations = AnnotationsDict(args=self.args)
+        pipeline = AnnotationsPipeline(peaks, self.args, queue=Queue())
+        for peak in peaks:
+            pipeline.annotate_utr_for_peak(self.db, peak, self.truncation_points, self.coverage_gaps)
+        while not pipeline.queue.empty():
+            result = pipeline.queue.get()
+            if result:
+                annotations.add_utr(result)
+        utrs = dict(annotations.utrs)
+        self.assertTrue(utrs)
+        merge_annotations(os.path.join(TEST_DIR, "Chr1.db"), annotations)
+        self.assertDictEqual(annotations.utrs, {})
+        self.assertEqual(len(annotations), self.db.count_features_of_type("gene"))
+        for gene, utr in utrs.items():
+            features = annotations[gene]
+            self.assertEqual(features["utr"].interval, utr.interval)
+            self.assertEqual(features["utr"].source, "peaks2utr")
+            self.assertEqual(features["utr"].attributes["transcript_id"], [utr.transcript_id])
+            self.assertEqual(features["transcript"].id, utr.transcript_id)
+            self.assertEqual(features["gene"].end, utr.end)
+            self.assertEqual(features["transcript"].end, utr.end)
+            self.assertListEqual([f.id for k, f in features.items() if k.startswith("feature_")],
+                                 [f.id for f in self.db.children(gene) if f.id not in (gene, utr.transcript_id)])
+
+    def test_merge_annotations_order(self):
+        self.args.gtf_in = False
+        lines = [
+            ("gene", 100, 200, "+", "ID=geneB"),
+            ("mRNA", 100, 200, "+", "ID=geneB.1;Parent=geneB"),
+            ("ncRNA_gene", 150, 300, "-", "ID=geneA"),
+            ("ncRNA", 150, 300, "-", "ID=geneA.1;Parent=geneA"),
+            ("gene", 100, 200, "-", "ID=geneC"),
+            ("mRNA", 100, 200, "-", "ID=geneC.1;Parent=geneC"),
+            ("gene", 50, 60, "+", "ID=geneAA"),
+        ]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            gff_in = os.path.join(tmp_dir, "genes.gff3")
+            with open(gff_in, "w") as f:
+                f.writelines("chr1\t.\t%s\t%d\t%d\t.\t%s\t.\t%s\n" % line for line in lines)
+            db_path = os.path.join(tmp_dir, "genes.db")
+            gffutils.create_db(gff_in, db_path)
+            annotations = AnnotationsDict(args=self.args)
+            annotations.add_utr(AnnotatedUTR("geneC", "geneC.1", 80, 99, AnnotationColour.Extended))
+            merge_annotations(db_path, annotations)
+            # Genes are merged in file order, whatever their ids, featuretypes and positions.
+            self.assertListEqual(list(annotations), ["geneB", "geneA", "geneC", "geneAA"])
+            self.assertEqual(annotations["geneC"]["gene"].start, 80)
+            self.assertListEqual([f.id for f in annotations["geneA"].values()], ["geneA", "geneA.1"])
+
+    def test_pass_through_annotations(self):
+        self.args.gtf_out = True
+        peaks = BroadPeaksList(broadpeak_fn=os.path.join(TEST_DIR, "test_forward_peaks.broadPeak"), strand="forward")
+        pipeline = AnnotationsPipeline(peaks, self.args, queue=Queue())
+        for peak in peaks:
+            pipeline.annotate_utr_for_peak(self.db, peak, self.truncation_points, self.coverage_gaps)
+        sorted_annotations = AnnotationsDict(args=self.args)
+        pass_through_annotations = AnnotationsDict(args=self.args)
+        while not pipeline.queue.empty():
+            result = pipeline.queue.get()
+            if result:
+                sorted_annotations.add_utr(result)
+                pass_through_annotations.add_utr(result)
+        self.assertTrue(sorted_annotations.utrs)
+        db_path = os.path.join(TEST_DIR, "Chr1.db")
+        merge_annotations(db_path, sorted_annotations)
+        merge_annotations(db_path, pass_through_annotations, include_untouched=False)
+        self.assertEqual(len(pass_through_annotations), len(sorted_annotations.filter(source="peaks2utr")))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            sorted_fn = os.path.join(tmp_dir, "sorted.gtf")
+            pass_through_fn = os.path.join(tmp_dir, "pass_through.gtf")
+            write_sorted_annotations(sorted_annotations, sorted_fn)
+            feature_counts = write_pass_through_annotations(pass_through_annotations, os.path.join(TEST_DIR, "Chr1.gtf"),
+                                                            pass_through_fn)
+            with open(os.path.join(TEST_DIR, "Chr1.gtf")) as fin, open(sorted_fn) as fsorted, \
+                    open(pass_through_fn) as fout:
+                input_lines = fin.readlines()
+                sorted_lines = fsorted.readlines()
+                output = fout.readlines()
+        # Lines of GFF_IN copied verbatim, with the same new features as sorted output, each after the last line of
+        # its transcript.
+        self.assertListEqual([line for line in output if "\tpeaks2utr\t" not in line], input_lines)
+        self.assertListEqual(sorted(line for line in output if "\tpeaks2utr\t" in line),
+                             sorted(line for line in sorted_lines if "\tpeaks2utr\t" in line))
+        for idx, line in enumerate(output):
+            if "\tpeaks2utr\t" in line:
+                transcript_id = "transcript_id " + line.split("transcript_id ")[1].split(";")[0] + ";"
+                self.assertIn(transcript_id, output[idx - 1])
+                self.assertFalse([prev for prev in output[idx + 1:]
+                                  if transcript_id in prev and "\tpeaks2utr\t" not in prev])
+        self.assertEqual(feature_counts[("three_prime_UTR", "peaks2utr")], len(pass_through_annotations))
+        self.assertEqual(feature_counts[("exon", "peaks2utr")], len(pass_through_annotations))
+
+
+class TestPassThroughAnnotations(unittest.TestCase):
+    def test_gff_rewrites_gene_and_transcript(self):
+        gff_in = os.path.join(TEST_DIR, "do_pseudo", "PVL_12_v1.gff")
+        args = prepare_argparser().parse_args(["", ""])
+        annotations = AnnotationsDict(args=args)
+        annotations.add_utr(AnnotatedUTR("PVL_120005000", "PVL_120005000_t42_1", 8269, 8400, AnnotationColour.Extended))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, "PVL_12_v1.db")
+            gffutils.create_db(gff_in, db_path, merge_strategy="create_unique")
+            merge_annotations(db_path, annotations, include_untouched=False)
+            self.assertListEqual(list(annotations), ["PVL_120005000"])
+            new_gff_fn = os.path.join(tmp_dir, "PVL_12_v1.new.gff3")
+            feature_counts = write_pass_through_annotations(annotations, gff_in, new_gff_fn)
+            with open(gff_in) as fin, open(new_gff_fn) as fout:
+                expected = fin.readlines()
+                output = fout.readlines()
+        for idx in [0, 1]:
+            expected[idx] = expected[idx].replace("\t8268\t", "\t8400\t")
+        # After last line of transcript, before polypeptide deriving from it.
+        expected.insert(7, "PVL_12_v1\tpeaks2utr\tthree_prime_UTR\t8269\t8400\t.\t+\t.\t"
+                           "ID=utr_PVL_120005000_t42_1_1;Parent=PVL_120005000_t42_1;colour=3\n")
+        self.assertListEqual(output, expected)
+        self.assertEqual(feature_counts[("three_prime_UTR", "peaks2utr")], 1)
+        self.assertEqual(sum(feature_counts.values()), len(expected))
+
+    def test_crlf_and_non_utf8_copied_verbatim(self):
+        gff_in = os.path.join(TEST_DIR, "do_pseudo", "PVL_12_v1.gff")
+        args = prepare_argparser().parse_args(["", ""])
+        annotations = AnnotationsDict(args=args)
+        annotations.add_utr(AnnotatedUTR("PVL_120005000", "PVL_120005000_t42_1", 8269, 8400, AnnotationColour.Extended))
+        with open(gff_in, "rb") as f:
+            lines = [line.rstrip(b"\n") + b"\r\n" for line in f]
+        # Latin-1 encoded attribute of an untouched gene.
+        lines[8] = lines[8].replace(b"\r\n", b";Note=caf\xe9\r\n")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_path = os.path.join(tmp_dir, "PVL_12_v1.db")
+            gffutils.create_db(gff_in, db_path, merge_strategy="create_unique")
+            merge_annotations(db_path, annotations, include_untouched=False)
+            crlf_gff_in = os.path.join(tmp_dir, "PVL_12_v1.crlf.gff")
+            with open(crlf_gff_in, "wb") as f:
+                f.writelines(lines)
+            new_gff_fn = os.path.join(tmp_dir, "PVL_12_v1.new.gff3")
+            write_pass_through_annotations(annotations, crlf_gff_in, new_gff_fn)
+            with open(new_gff_fn, "rb") as f:
+                output = f.read().splitlines(keepends=True)
+        self.assertListEqual(output[:2], [line.replace(b"\t8268\t", b"\t8400\t") for line in lines[:2]])
+        self.assertListEqual(output[2:7], lines[2:7])
+        self.assertTrue(output[7].startswith(b"PVL_12_v1\tpeaks2utr\tthree_prime_UTR\t8269\t8400\t"))
+        self.assertTrue(output[7].endswith(b"colour=3\r\n"))
+        self.assertListEqual(output[8:], lines[7:])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,200 @@
+import gc
+import os.path
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import gffutils
+import numpy as np
+
+from peaks2utr import prepare_argparser
+from peaks2utr.collections import AnnotationsDict, DiskAnnotationsDict, FeatureStore, SPATTruncationPointsDict, \
+    ZeroCoverageIntervalsDict
+from peaks2utr.constants import AnnotationColour, FeatureTypes
+from peaks2utr.models import AnnotatedUTR, Feature
+from peaks2utr.postprocess import merge_annotations
+
+TEST_DIR = os.path.dirname(__file__)
+
+
+class TestAnnotationsDict(unittest.TestCase):
+    def _annotations(self, dict=None, args=None):
+        return AnnotationsDict(dict, args=args)
+
+    @staticmethod
+    def _features(gene_id, utr_end, source="peaks2utr"):
+        return {
+            "gene": Feature("chr1", id=gene_id, featuretype="gene", start=100, end=utr_end, strand="+"),
+            "transcript": Feature("chr1", id=gene_id + ".1", featuretype="mRNA", start=100, end=utr_end, strand="+"),
+            "feature_0": Feature("chr1", ".", featuretype="five_prime_UTR", id=gene_id + ":5utr", start=100, end=150,
+                                 strand="+"),
+            "utr": Feature("chr1", source, featuretype="three_prime_UTR", id=gene_id + ":3utr", start=500, end=utr_end,
+                           strand="+"),
+        }
+
+    def _assert_counts(self, annotations):
+        features = [f for features in annotations.values() for f in features.values()]
+        for kwargs in [{}, {"featuretype": "gene"}, {"source": "peaks2utr"}, {"featuretype": FeatureTypes.ThreePrimeUTR},
+                       {"featuretype": FeatureTypes.ThreePrimeUTR, "source": "peaks2utr"},
+                       {"featuretype": ["gene", "mRNA"], "source": "."}, {"featuretype": "exon"}, {"end": 900},
+                       {"featuretype": "three_prime_UTR", "end": [600, 900]}]:
+            expected = [f for f in features if all(
+                getattr(f, attr) in obj if isinstance(obj, list) else getattr(f, attr) == obj
+                for attr, obj in kwargs.items())]
+            self.assertListEqual(sorted(f.id for f in annotations.filter(**kwargs)), sorted(f.id for f in expected))
+            self.assertEqual(annotations.count(**kwargs), len(expected))
+
+    def test_counts_and_indexes(self):
+        annotations = self._annotations({"gene1": self._features("gene1", 600, source=".")})
+        annotations.update({"gene2": self._features("gene2", 600)})
+        self._assert_counts(annotations)
+        self.assertEqual(annotations.count(featuretype=FeatureTypes.ThreePrimeUTR, source="peaks2utr"), 1)
+        # 3' UTR within existing one is ignored, otherwise replaces it.
+        annotations["gene2"] = self._features("gene2", 550)
+        self.assertEqual(annotations["gene2"]["utr"].end, 600)
+        annotations["gene1"] = self._features("gene1", 900)
+        self._assert_counts(annotations)
+        self.assertEqual(annotations.count(featuretype=FeatureTypes.ThreePrimeUTR, source="peaks2utr"), 2)
+        del annotations["gene2"]
+        self._assert_counts(annotations)
+        self.assertDictEqual(dict(annotations.counts), {(featuretype, source): 1 for featuretype, source in [
+            ("gene", "."), ("mRNA", "."), ("five_prime_UTR", "."), ("three_prime_UTR", "peaks2utr")]})
+
+
+class TestDiskAnnotationsDict(TestAnnotationsDict):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _annotations(self, dict=None, args=None, cache_size=1):
+        return DiskAnnotationsDict(dict, args=args, store_fn=os.path.join(self.tmp_dir.name, "annotations_store.db"),
+                                   cache_size=cache_size)
+
+    def test_sorted_output(self):
+        gff_in = os.path.join(TEST_DIR, "do_pseudo", "PVL_12_v1.gff")
+        db_path = os.path.join(self.tmp_dir.name, "PVL_12_v1.db")
+        gffutils.create_db(gff_in, db_path, merge_strategy="create_unique")
+        args = prepare_argparser().parse_args(["", ""])
+        for gtf_out in [False, True]:
+            args.gtf_out = gtf_out
+            outputs = []
+            for annotations in [AnnotationsDict(args=args), self._annotations(args=args, cache_size=3)]:
+                annotations.add_utr(AnnotatedUTR("PVL_120005000", "PVL_120005000_t42_1", 8269, 8400,
+                                                 AnnotationColour.Extended))
+                merge_annotations(db_path, annotations)
+                outputs.append(list(annotations.iter_sorted_feature_strings()))
+            self.assertEqual(len(annotations.data.cache), 3)
+            self.assertListEqual(outputs[1], outputs[0])
+            self.assertIn("\tpeaks2utr\t", "".join(outputs[0]))
+
+    def test_merge_holds_cache_size_genes(self):
+        db_path = os.path.join(self.tmp_dir.name, "PVL_12_v1.db")
+        gffutils.create_db(os.path.join(TEST_DIR, "do_pseudo", "PVL_12_v1.gff"), db_path, merge_strategy="create_unique")
+        annotations = self._annotations(cache_size=5)
+        live_features = []
+        setitem = FeatureStore.__setitem__
+
+        def count_live_features(store, gene, features):
+            setitem(store, gene, features)
+            live_features.append(sum(1 for obj in gc.get_objects() if isinstance(obj, gffutils.Feature)))
+
+        with patch.object(FeatureStore, "__setitem__", count_live_features):
+            merge_annotations(db_path, annotations)
+        self.assertGreater(len(annotations), 100)
+        self.assertEqual(len(live_features), len(annotations))
+        # Features of genes in cache, and of those being merged and read ahead, at most.
+        sizes = sorted((len(annotations.data[gene]) for gene in annotations), reverse=True)
+        self.assertLessEqual(max(live_features), sum(sizes[:5 + 2]))
+
+    def test_close_deletes_store(self):
+        annotations = self._annotations({"gene1": self._features("gene1", 600)})
+        store_fn = annotations.data.db_fn
+        self.assertTrue(os.path.isfile(store_fn))
+        annotations.close()
+        self.assertFalse(os.path.exists(store_fn))
+        self.assertEqual(annotations.count(featuretype=FeatureTypes.ThreePrimeUTR), 1)
+        with FeatureStore(store_fn) as store:
+            store["gene1"] = self._features("gene1", 600)
+        self.assertFalse(os.path.exists(store_fn))
+
+
+class TestSPATTruncationPointsDict(unittest.TestCase):
+    def setUp(self):
+        self.truncation_points = SPATTruncationPointsDict({"chr1": {"300": 12, "100": 10, "200": 15}})
+
+    def test_max_in_range(self):
+        self.assertEqual(self.truncation_points.max_in_range("chr1", 100, 250), 200)
+        self.assertEqual(self.truncation_points.max_in_range("chr1", 1, 1000), 300)
+        self.assertEqual(self.truncation_points.max_in_range("chr1", 300, 300), 300)
+        self.assertIsNone(self.truncation_points.max_in_range("chr1", 101, 199))
+        self.assertIsNone(self.truncation_points.max_in_range("chr1", 300, 299))
+        self.assertIsNone(self.truncation_points.max_in_range("chr2", 1, 1000))
+
+    def test_min_in_range(self):
+        self.assertEqual(self.truncation_points.min_in_range("chr1", 150, 1000), 200)
+        self.assertEqual(self.truncation_points.min_in_range("chr1", 1, 1000), 100)
+        self.assertEqual(self.truncation_points.min_in_range("chr1", 100, 100), 100)
+        self.assertIsNone(self.truncation_points.min_in_range("chr1", 301, 1000))
+        self.assertIsNone(self.truncation_points.min_in_range("chr1", 200, 199))
+        self.assertIsNone(self.truncation_points.min_in_range("chr2", 1, 1000))
+
+    def test_in_ranges(self):
+        starts, ends = zip(*[(s, e) for s in range(0, 350, 10) for e in range(0, 350, 10)])
+        for chr in ["chr1", "chr2"]:
+            self.assertListEqual(
+                self.truncation_points.max_in_ranges(chr, np.array(starts), np.array(ends)).tolist(),
+                [-1 if p is None else p for p in map(self.truncation_points.max_in_range, [chr] * len(starts), starts, ends)])
+            self.assertListEqual(
+                self.truncation_points.min_in_ranges(chr, np.array(starts), np.array(ends)).tolist(),
+                [-1 if p is None else p for p in map(self.truncation_points.min_in_range, [chr] * len(starts), starts, ends)])
+
+
+class TestZeroCoverageIntervalsDict(unittest.TestCase):
+    @staticmethod
+    def _scan(bed_fn, chr, base):
+        """
+        1-based included intervals from bed_fn on chr that contain base.
+        """
+        with open(bed_fn) as f:
+            intervals = [line.split() for line in f]
+        return sorted((int(s) + 1, int(e)) for c, s, e in intervals if c == chr and int(s) + 1 <= base <= int(e))
+
+    def _assert_filter(self, bed_fn, chr, bases):
+        scans = [self._scan(bed_fn, chr, base) for base in bases]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            store_fn = os.path.join(tmp_dir, "coverage_gaps.npy")
+            ZeroCoverageIntervalsDict(bed_fn=bed_fn).write(store_fn)
+            for coverage_gaps in [ZeroCoverageIntervalsDict(bed_fn=bed_fn), ZeroCoverageIntervalsDict(store_fn=store_fn)]:
+                for base, scan in zip(bases, scans):
+                    self.assertListEqual(sorted((i.start, i.end) for i in coverage_gaps.filter(chr, base)), scan)
+                self.assertListEqual(coverage_gaps.gap_edges(chr, list(bases)).tolist(),
+                                     [min(s for s, _ in scan) if scan else -1 for scan in scans])
+                self.assertListEqual(coverage_gaps.gap_edges(chr, list(bases), reverse=True).tolist(),
+                                     [max(e for _, e in scan) if scan else -1 for scan in scans])
+
+    def test_filter(self):
+        bed_fn = os.path.join(TEST_DIR, "case3", "forward_coverage_gaps.bed")
+        self._assert_filter(bed_fn, "chr12", range(54619000, 54627000, 3))
+        self.assertListEqual(ZeroCoverageIntervalsDict(bed_fn=bed_fn).filter("chr1", 54619023), [])
+
+    def test_filter_unsorted_overlapping(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".bed") as f:
+            f.write("chr1\t50\t60\nchr2\t0\t10\nchr1\t0\t100\nchr1\t55\t58\n")
+            f.flush()
+            self._assert_filter(f.name, "chr1", range(0, 110))
+            self._assert_filter(f.name, "chr2", range(0, 20))
+            self.assertListEqual(list(ZeroCoverageIntervalsDict(bed_fn=f.name, chrs={"chr2"})), ["chr2"])
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                store_fn = os.path.join(tmp_dir, "coverage_gaps.npy")
+                ZeroCoverageIntervalsDict(bed_fn=f.name).write(store_fn)
+                self.assertListEqual(list(ZeroCoverageIntervalsDict(store_fn=store_fn, chrs={"chr2"})), ["chr2"])
+
+    def test_empty(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".bed") as f:
+            self.assertListEqual(ZeroCoverageIntervalsDict(bed_fn=f.name).filter("chr1", 1), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import copy
+import os.path
+import tempfile
+import unittest
+
+import gffutils
+
+from peaks2utr.constants import GFFUTILS_GFF_DIALECT, GFFUTILS_GTF_DIALECT
+from peaks2utr.formatting import FeatureSerializer
+from peaks2utr.models import Feature, FeatureDB
+
+TEST_DIR = os.path.dirname(__file__)
+
+
+class TestFeatureSerializer(unittest.TestCase):
+    def setUp(self):
+        self.serializer = FeatureSerializer()
+
+    def assertSerialized(self, feature):
+        self.assertEqual(self.serializer(feature), str(feature) + "\n")
+
+    def test_annotation_files(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for gff_in in ["Chr1.gtf", os.path.join("case2", "case2.gtf"), os.path.join("do_pseudo", "PVL_12_v1.gff"),
+                           os.path.join("no_strand_overlap", "Chr1.gff")]:
+                db_path = os.path.join(tmp_dir, "annotations.db")
+                gffutils.create_db(os.path.join(TEST_DIR, gff_in), db_path, force=True, merge_strategy="create_unique")
+                for feature in FeatureDB(db_path).all_features():
+                    self.assertSerialized(feature)
+                    # Output dialects of peaks2utr
+                    for dialect in [GFFUTILS_GFF_DIALECT, GFFUTILS_GTF_DIALECT]:
+                        feature.dialect = dialect
+                        self.assertSerialized(feature)
+
+    def test_attributes(self):
+        feature = Feature("chr1", "src", "exon", 1, 10, ".", "-", "0", id="e1", dialect=GFFUTILS_GFF_DIALECT,
+                          attributes={"Parent": ["t1", "t2"], "Note": ["a;b=c,d%", "tab\there"], "ID": ["e1"],
+                                      "empty": [], "blank": [""], "colour": ["3"]})
+        self.assertSerialized(feature)
+        for keep_order, sort_attribute_values in [(True, False), (False, True), (True, True)]:
+            feature.keep_order = keep_order
+            feature.sort_attribute_values = sort_attribute_values
+            self.assertSerialized(feature)
+        for dialect in [GFFUTILS_GTF_DIALECT, dict(GFFUTILS_GTF_DIALECT, **{"repeated keys": True})]:
+            feature.dialect = dialect
+            self.assertSerialized(feature)
+        self.assertEqual(self.serializer(Feature("chr1", dialect=GFFUTILS_GFF_DIALECT)), str(Feature("chr1")) + "\n")
+        self.assertSerialized(Feature("chr1", start=5, extra=["x", "y"], dialect=GFFUTILS_GFF_DIALECT))
+
+    def test_featuretype(self):
+        feature = Feature("chr1", "peaks2utr", "three_prime_UTR", 1, 10, strand="+", dialect=GFFUTILS_GTF_DIALECT,
+                          attributes={"gene_id": ["g1"], "transcript_id": ["t1"]})
+        exon = copy.copy(feature)
+        exon.featuretype = "exon"
+        self.assertEqual(self.serializer(feature, "exon"), str(exon) + "\n")
+        self.assertEqual(feature.featuretype, "three_prime_UTR")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,22 @@
+import itertools
+import unittest
+
+from peaks2utr.models import Interval
+
+
+class TestInterval(unittest.TestCase):
+    def test_matches_range_set_semantics(self):
+        bounds = [(s, e) for s, e in itertools.product(range(1, 7), repeat=2)]
+        for (s1, e1), (s2, e2) in itertools.product(bounds, repeat=2):
+            a, b = Interval(s1, e1), Interval(s2, e2)
+            sa, sb = set(range(s1, e1 + 1)), set(range(s2, e2 + 1))
+            self.assertEqual(a.issubset(b), sa.issubset(sb))
+            self.assertEqual(a.overlaps(b), bool(sa.intersection(sb)))
+            self.assertEqual(len(a.intersection(b)), len(sa.intersection(sb)))
+            self.assertEqual(a == b, sa == sb)
+            self.assertEqual(len(a), len(sa))
+            self.assertEqual(s2 in a, s2 in sa)
+
+
+if __name__ == '__main__':
+    unittest.main()
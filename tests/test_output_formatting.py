@@ -1,3 +1,5 @@
+import os.path
+import tempfile
 import unittest
 from unittest.mock import MagicMock
 
@@ -5,8 +7,11 @@ from peaks2utr import prepare_argparser
 from peaks2utr.collections import AnnotationsDict
 from peaks2utr.constants import FeatureTypes, GFFUTILS_GTF_DIALECT
 from peaks2utr.models import Feature, UTR
+from peaks2utr.postprocess import write_sorted_annotations
 from peaks2utr.utils import get_output_filename
 
+TEST_DIR = os.path.dirname(__file__)
+
 
 class TestOutputFormatting(unittest.TestCase):
 
@@ -156,6 +161,72 @@ class TestOutputFormatting(unittest.TestCase):
         self.assertListEqual(gene.strip().split("\t"), expected_gene)
         self.assertListEqual(feature_0.strip().split("\t"), expected_feature_0)
 
+    def _unsorted_annotations(self):
+        def feature(chr, id, featuretype, start, end, parent=None):
+            attributes = {"ID": [id]}
+            if parent:
+                attributes["Parent"] = [parent]
+            return Feature(chr, id=id, featuretype=featuretype, start=start, end=end, strand="+", attributes=attributes)
+
+        annotations = AnnotationsDict(args=self.args)
+        annotations.update({
+            "gene2": {
+                "gene": feature("chr2", "gene2", "gene", 5000, 6000),
+                "feature_1": feature("chr2", "exon2", "exon", 5500, 6000, "gene2:mRNA"),
+                "feature_2": feature("chr2", "gene2:mRNA2", "mRNA", 5500, 6000, "gene2"),
+                "feature_3": feature("chr2", "exon1", "exon", 5000, 5200, "gene2:mRNA"),
+                "transcript": feature("chr2", "gene2:mRNA", "mRNA", 5000, 6000, "gene2"),
+            },
+            "gene3": {"gene": feature("chr2", "gene3", "gene", 100, 200)},
+            "gene1": {
+                "gene": feature("chr10", "gene1", "gene", 3000, 4000),
+                "feature_1": feature("chr10", "gene1:mRNA", "mRNA", 3000, 4000, "gene1"),
+            },
+        })
+        return annotations
+
+    def test_sorted_gff(self):
+        self.args.gtf_in = False
+        self.args.gtf_out = False
+        lines = [line.rstrip("\n").split("\t") for line in self._unsorted_annotations().iter_sorted_feature_strings()]
+        self.assertListEqual([line[0] if len(line) == 1 else line[8] for line in lines], [
+            "##gff-version 3",
+            "##sequence-region   chr10 3000 4000",
+            "##sequence-region   chr2 100 6000",
+            "ID=gene1",
+            "ID=gene1:mRNA;Parent=gene1",
+            "###",
+            "ID=gene3",
+            "###",
+            "ID=gene2",
+            "ID=gene2:mRNA;Parent=gene2",
+            "ID=exon1;Parent=gene2:mRNA",
+            "ID=exon2;Parent=gene2:mRNA",
+            "ID=gene2:mRNA2;Parent=gene2",
+            "###",
+        ])
+
+    def test_sorted_gff_file(self):
+        self.args.gtf_in = False
+        self.args.gtf_out = False
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_fn = os.path.join(tmp_dir, "sorted_output.gff3")
+            write_sorted_annotations(self._unsorted_annotations(), output_fn)
+            with open(output_fn, "rb") as f, open(os.path.join(TEST_DIR, "sorted_output.gff3"), "rb") as expected:
+                self.assertEqual(f.read(), expected.read())
+
+    def test_sorted_gtf(self):
+        self.args.gtf_in = False
+        self.args.gtf_out = True
+        # GTF output is left in order of annotations.
+        lines = [line.split("\t") for line in self._unsorted_annotations().iter_sorted_feature_strings()]
+        self.assertListEqual([(line[0], line[2], line[3]) for line in lines], [
+            ("chr2", "exon", "5500"),
+            ("chr2", "transcript", "5500"),
+            ("chr2", "exon", "5000"),
+            ("chr2", "transcript", "5000"),
+            ("chr10", "transcript", "3000"),
+        ])
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,258 @@
+from collections import defaultdict
+import json
+import os
+import os.path
+import random
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import pysam
+
+from peaks2utr import prepare_argparser
+from peaks2utr.collections import LazyZeroCoverageIntervalsDict, ZeroCoverageIntervalsDict
+from peaks2utr.coverage import zero_coverage_intervals
+from peaks2utr.models import SoftClippedRead
+from peaks2utr.preprocess import BAMSplitter, count_poly_tail_truncation_points
+from peaks2utr.utils import read_truncation_points
+
+TEST_DIR = os.path.dirname(__file__)
+BAM_IN = os.path.join(TEST_DIR, "do_pseudo", "E_GEOD_61252.12.slice.bam")
+
+
+def write_soft_clipped_bam(bam_fn, num_reads=2000, seed=0):
+    """
+    Write an indexed BAM file of random reads on two chromosomes, some of which have soft-clipped poly-A/T tails.
+    """
+    rng = random.Random(seed)
+    header = {"HD": {"VN": "1.6", "SO": "coordinate"},
+              "SQ": [{"SN": "chr1", "LN": 5000}, {"SN": "chr2", "LN": 3000}]}
+    cigars = ["60M", "45M15S", "15S45M", "5H45M15S", "15S45M5H", "20S20M100N20M", "30M1D15M15S", "60M"]
+    reads = []
+    with pysam.AlignmentFile(bam_fn, "wb", header=header) as f:
+        for i in range(num_reads):
+            seg = pysam.AlignedSegment(f.header)
+            seg.query_name = "read_%d" % i
+            seg.reference_id = rng.randrange(2)
+            # Cluster reads so that truncation points pile up.
+            seg.reference_start = rng.choice(range(100, 2500, 40)) + rng.randrange(3)
+            seg.cigarstring = rng.choice(cigars)
+            seg.flag = rng.choice([0, 16, 16 | 256])
+            seq = [rng.choice("ACGT") for _ in range(seg.infer_query_length())]
+            tail = rng.choice("AT") * rng.randrange(8, 15)
+            if rng.random() < 0.5:
+                seq[-len(tail):] = tail
+            if rng.random() < 0.5:
+                seq[:len(tail)] = tail
+            seg.query_sequence = "".join(seq)
+            seg.mapping_quality = 60
+            reads.append(seg)
+        for seg in sorted(reads, key=lambda x: (x.reference_id, x.reference_start)):
+            f.write(seg)
+    pysam.index(bam_fn)
+
+
+def count_soft_clipped_reads(bam_fn, min_poly_tail):
+    unmapped = defaultdict(lambda: defaultdict(int))
+    with pysam.AlignmentFile(bam_fn, "rb") as f:
+        for seg in f.fetch(until_eof=True):
+            if seg.is_unmapped:
+                continue
+            read = SoftClippedRead(seg.reference_name, seg.reference_start, seg.reference_end, seg.cigarstring,
+                                   seg.query_sequence, "reverse" if seg.is_reverse else "forward")
+            if read.poly_tail_exists(min_poly_tail):
+                unmapped[read.chr][str(read.extremity)] += 1
+    return unmapped
+
+
+class TestBAMSplitter(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.patcher = patch("peaks2utr.utils.CACHE_DIR", self.cache_dir.name)
+        self.patcher.start()
+        argparser = prepare_argparser()
+        self.args = argparser.parse_args(["", BAM_IN, "-p", "2"])
+        self.splitter = BAMSplitter("E_GEOD_61252.12.slice", self.args)
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.cache_dir.cleanup()
+
+    def _strand_bam(self, strand):
+        return os.path.join(self.cache_dir.name, "E_GEOD_61252.12.slice.%s.bam" % strand)
+
+    @staticmethod
+    def _read_names(bam_fn):
+        with pysam.AlignmentFile(bam_fn, "rb") as f:
+            return [(seg.query_name, seg.flag, seg.reference_start) for seg in f.fetch(until_eof=True)]
+
+    def test_split_strands_single_pass(self):
+        self.splitter.split_strands()
+        with pysam.AlignmentFile(BAM_IN, "rb") as f:
+            reads = [(seg.query_name, seg.flag, seg.reference_start) for seg in f.fetch(until_eof=True)]
+        # Equivalent to samtools view -F 20 / -f 16
+        self.assertListEqual(self._read_names(self._strand_bam("forward")), [r for r in reads if not r[1] & 20])
+        self.assertListEqual(self._read_names(self._strand_bam("reverse")), [r for r in reads if r[1] & 16])
+        self.assertEqual(len(self.splitter.gap_outputs), 2)
+
+    def test_split_strands_cached(self):
+        self.splitter.split_strands()
+        forward_mtime = os.stat(self._strand_bam("forward")).st_mtime_ns
+        os.remove(self._strand_bam("reverse"))
+        self.splitter.split_strands()
+        self.assertEqual(os.stat(self._strand_bam("forward")).st_mtime_ns, forward_mtime)
+        self.assertTrue(os.path.isfile(self._strand_bam("reverse")))
+
+
+class TestSPATPileups(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.patcher = patch("peaks2utr.utils.CACHE_DIR", self.cache_dir.name)
+        self.patcher.start()
+        self.bam_in = os.path.join(self.cache_dir.name, "soft_clipped.bam")
+        write_soft_clipped_bam(self.bam_in)
+        self.argparser = prepare_argparser()
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.cache_dir.cleanup()
+
+    def test_count_poly_tail_truncation_points(self):
+        for tail_len in [0, 10, 12]:
+            with pysam.AlignmentFile(self.bam_in, "rb") as samfile:
+                self.assertDictEqual(
+                    json.loads(json.dumps(count_poly_tail_truncation_points(samfile, samfile.fetch(until_eof=True),
+                                                                            tail_len))),
+                    json.loads(json.dumps(count_soft_clipped_reads(self.bam_in, tail_len))))
+
+    def _pileup(self, *args):
+        splitter = BAMSplitter("soft_clipped", self.argparser.parse_args(["", self.bam_in, "--min-pileups", "1"] + list(args)))
+        splitter.split_strands()
+        splitter.shard_strand_regions()
+        splitter.pileup_soft_clipped_reads()
+        pileups = {}
+        for strand in ["forward", "reverse"]:
+            store = read_truncation_points(os.path.join(self.cache_dir.name, "%s_truncation_points.npy" % strand))
+            pileups[strand] = {chr: {str(r["pos"]): int(r["count"]) for r in records} for chr, records in store.items()}
+        for f in os.listdir(self.cache_dir.name):
+            if "_truncation_points" in f:
+                os.remove(os.path.join(self.cache_dir.name, f))
+        return pileups, splitter
+
+    def test_region_sharded_pileups(self):
+        BAMSplitter("soft_clipped", self.argparser.parse_args(["", self.bam_in])).split_strands()
+        expected = json.loads(json.dumps({
+            strand: count_soft_clipped_reads(os.path.join(self.cache_dir.name, "soft_clipped.%s.bam" % strand), 10)
+            for strand in ["forward", "reverse"]
+        }))
+        self.assertTrue(expected["forward"] and expected["reverse"])
+        for args in [[], ["--spat-region-size", "0"], ["--spat-region-size", "700", "-p", "3"]]:
+            pileups, splitter = self._pileup(*args)
+            self.assertDictEqual(pileups, expected)
+        self.assertEqual(len(splitter.spat_outputs), 2 * (8 + 5))
+
+    def test_cached_shards_resumed_with_other_region_size(self):
+        expected, _ = self._pileup()
+        splitter = BAMSplitter("soft_clipped", self.argparser.parse_args(["", self.bam_in, "--min-pileups", "1",
+                                                                          "--spat-region-size", "700"]))
+        splitter.shard_strand_regions()
+        splitter.pileup_soft_clipped_reads()
+        # Interrupted after piling up shards, then resumed with regions of another size.
+        for strand in ["forward", "reverse"]:
+            os.remove(os.path.join(self.cache_dir.name, "%s_truncation_points.npy" % strand))
+        pileups, splitter = self._pileup("--spat-region-size", "1000")
+        self.assertDictEqual(pileups, expected)
+
+    def test_min_pileups(self):
+        pileups, _ = self._pileup("--min-pileups", "2")
+        self.assertTrue(pileups["forward"])
+        for strand, store in pileups.items():
+            for chr, points in store.items():
+                self.assertTrue(points)
+                self.assertTrue(all(count >= 2 for count in points.values()))
+                self.assertListEqual(list(map(int, points)), sorted(map(int, points)))
+
+
+class TestZeroCoverageIntervals(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.patcher = patch("peaks2utr.utils.CACHE_DIR", self.cache_dir.name)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.cache_dir.cleanup()
+
+    @staticmethod
+    def _per_base_gaps(bam_fn):
+        """
+        Zero-coverage intervals from a per-base depth array, counting matches and deletions as covered.
+        """
+        gaps = []
+        with pysam.AlignmentFile(bam_fn, "rb") as f:
+            for chr, length in zip(f.references, f.lengths):
+                depth = [0] * length
+                for seg in f.fetch(chr):
+                    if seg.is_unmapped:
+                        continue
+                    pos = seg.reference_start
+                    for op, n in seg.cigartuples:
+                        if op in (0, 2, 7, 8):
+                            for i in range(pos, pos + n):
+                                depth[i] += 1
+                        if op in (0, 2, 3, 7, 8):
+                            pos += n
+                start = None
+                for i, d in enumerate(depth + [1]):
+                    if d == 0 and start is None:
+                        start = i
+                    elif d and start is not None:
+                        gaps.append("%s\t%d\t%d" % (chr, start, min(i, length)))
+                        start = None
+        return gaps
+
+    def test_find_zero_coverage_intervals(self):
+        bam_in = os.path.join(self.cache_dir.name, "soft_clipped.bam")
+        write_soft_clipped_bam(bam_in)
+        args = prepare_argparser().parse_args(["", bam_in, "-p", "2"])
+        splitter = BAMSplitter("soft_clipped", args)
+        splitter.split_strands()
+        splitter.find_zero_coverage_intervals()
+        for strand in ["forward", "reverse"]:
+            with open(os.path.join(self.cache_dir.name, "%s_coverage_gaps.bed" % strand)) as f:
+                self.assertListEqual(
+                    f.read().splitlines(),
+                    self._per_base_gaps(os.path.join(self.cache_dir.name, "soft_clipped.%s.bam" % strand)))
+
+    def test_windowed_zero_coverage_intervals(self):
+        bam_in = os.path.join(self.cache_dir.name, "soft_clipped.bam")
+        write_soft_clipped_bam(bam_in, num_reads=300)
+        for min_cov in [1, 3]:
+            for chr, length in [("chr1", 5000), ("chr2", 3000)]:
+                expected = zero_coverage_intervals(bam_in, chr, 0, length, min_cov)
+                self.assertTrue(len(expected[0]))
+                # Small windows so that gaps and reads span several of them.
+                for window_size in [1, 37, 1000]:
+                    starts, ends = zero_coverage_intervals(bam_in, chr, 0, length, min_cov, window_size=window_size)
+                    self.assertListEqual(starts.tolist(), expected[0].tolist())
+                    self.assertListEqual(ends.tolist(), expected[1].tolist())
+
+    def test_lazy_zero_coverage_intervals(self):
+        bam_in = os.path.join(self.cache_dir.name, "soft_clipped.bam")
+        write_soft_clipped_bam(bam_in, num_reads=300)
+        splitter = BAMSplitter("soft_clipped", prepare_argparser().parse_args(["", bam_in]))
+        splitter.split_strands()
+        splitter.find_zero_coverage_intervals()
+        for strand in ["forward", "reverse"]:
+            eager = ZeroCoverageIntervalsDict(bed_fn=os.path.join(self.cache_dir.name, "%s_coverage_gaps.bed" % strand))
+            # Small windows so that gaps span several of them.
+            lazy = LazyZeroCoverageIntervalsDict(bam_fn=os.path.join(self.cache_dir.name, "soft_clipped.%s.bam" % strand),
+                                                 window_size=50)
+            for chr, length in [("chr1", 5000), ("chr2", 3000), ("chrX", 100)]:
+                for base in range(1, length + 1, 7):
+                    self.assertListEqual([(i.start, i.end) for i in lazy.filter(chr, base)],
+                                         [(i.start, i.end) for i in eager.filter(chr, base)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import os
+import os.path
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+import gffutils
+
+from peaks2utr.constants import FeatureTypes
+from peaks2utr.exceptions import PysamError
+from peaks2utr.models import FeatureDB
+from peaks2utr.utils import Counter, balance_shards, children_of_genes, features_dict_for_gene, \
+    iter_multiprocess_over_dict, merge_truncation_points, multiprocess_over_dict, read_truncation_points, \
+    write_truncation_points
+
+TEST_DIR = os.path.dirname(__file__)
+
+
+class TestMultiprocessOverDict(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_results_streamed_largest_first(self):
+        d = {1: "a", 3: "b", 2: "c"}
+        results = list(iter_multiprocess_over_dict(lambda k, v: v * k, d, processors=1, size=lambda k: k))
+        self.assertListEqual(results, [(3, "b", "bbb"), (2, "c", "cc"), (1, "a", "a")])
+
+    def test_bounded_processes(self):
+        start = time.time()
+        results = list(iter_multiprocess_over_dict(lambda k, v: time.sleep(0.2), dict.fromkeys(range(4)), processors=2))
+        self.assertEqual(len(results), 4)
+        # Two waves of two processes.
+        self.assertGreaterEqual(time.time() - start, 0.4)
+
+    def test_retries(self):
+        marker = os.path.join(self.tmp_dir.name, "marker")
+
+        def fail_once(k, v):
+            if not os.path.isfile(marker):
+                open(marker, "w").close()
+                os._exit(1)
+            return v
+
+        self.assertListEqual(list(iter_multiprocess_over_dict(fail_once, {"k": "v"}, retries=1)), [("k", "v", "v")])
+
+    def test_raises_after_retries(self):
+        def _count_unmapped_pileups(k, v):
+            os._exit(1)
+
+        with self.assertRaises(PysamError):
+            multiprocess_over_dict(_count_unmapped_pileups, {"k": "v"}, retries=1)
+
+
+class TestBalanceShards(unittest.TestCase):
+    def test_longest_processing_time_first(self):
+        weights = {"a": 7, "b": 5, "c": 4, "d": 3, "e": 3, "f": 2}
+        self.assertListEqual(balance_shards(weights, 3), [["a", "f"], ["b", "e"], ["c", "d"]])
+        self.assertListEqual(balance_shards(weights, 1), [["a", "b", "c", "d", "e", "f"]])
+        self.assertListEqual(balance_shards({"a": 1}, 4), [["a"]])
+
+
+class TestCounter(unittest.TestCase):
+    @patch.object(Counter, "seen", set())
+    def test_first_counter_wins(self):
+        first, second = Counter(), Counter()
+        for key in ["a", "b", "a"]:
+            first.add(key)
+        second.add("b")
+        second.add("c")
+        self.assertEqual(int(first), 2)
+        self.assertEqual(int(second), 1)
+        # Keys counted by Counters of workers are reduced into those of the parent, still counted once.
+        second.update(["a", "d", "d"])
+        first.update(["d"])
+        self.assertSetEqual(first.keys, {"a", "b"})
+        self.assertSetEqual(second.keys, {"c", "d"})
+
+
+class TestChildrenOfGenes(unittest.TestCase):
+    def test_matches_features_dict_per_gene(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for gff_in in ["Chr1.gtf", os.path.join("do_pseudo", "PVL_12_v1.gff"),
+                           os.path.join("no_strand_overlap", "Chr1.gff")]:
+                db_path = os.path.join(tmp_dir, "annotations.db")
+                gffutils.create_db(os.path.join(TEST_DIR, gff_in), db_path, force=True, merge_strategy="create_unique")
+                db = FeatureDB(db_path)
+                featuretypes = FeatureTypes.Gene + FeatureTypes.NonCodingGene
+                groups = list(children_of_genes(db, featuretypes))
+                parents = [parent for parent, _ in groups]
+                self.assertListEqual(parents, [gene.id for gene in db.all_features(featuretype=featuretypes, order_by="rowid")
+                                               if gene.id in parents])
+                children = dict(groups)
+                for gene in db.all_features(featuretype=featuretypes):
+                    self.assertListEqual(
+                        [(k, str(f)) for k, f in features_dict_for_gene(db, gene, children=children.get(gene.id, []))
+                         .items()],
+                        [(k, str(f)) for k, f in features_dict_for_gene(db, gene).items()])
+
+
+class TestTruncationPoints(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_write_read_merge(self):
+        shards = [
+            {"chr1": {30: 2, 10: 1, 20: 5}, "chr2": {5: 1}},
+            {"chr1": {10: 4}},
+            {"chr2": {5: 2, 7: 1}, "chr3": {1: 1}},
+            {},
+        ]
+        stores = []
+        for idx, shard in enumerate(shards):
+            fn = os.path.join(self.tmp_dir.name, "shard%d.npy" % idx)
+            write_truncation_points(fn, shard)
+            stores.append(read_truncation_points(fn))
+        self.assertListEqual(stores[0]["chr1"]["pos"].tolist(), [10, 20, 30])
+        self.assertListEqual(stores[0]["chr1"]["count"].tolist(), [1, 5, 2])
+        self.assertDictEqual(stores[3], {})
+        merged = merge_truncation_points(stores, min_pileups=3)
+        self.assertDictEqual({chr: (p.tolist(), c.tolist()) for chr, (p, c) in merged.items()},
+                             {"chr1": ([10, 20], [5, 5]), "chr2": ([5], [3])})
+
+
+if __name__ == '__main__':
+    unittest.main()